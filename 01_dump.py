@@ -1,30 +1,53 @@
 #!/usr/bin/env python3
 import tqdm
+import atexit
 from argparse import ArgumentParser
 
 from panda import Panda
 from tp20 import TP20Transport
+from can_trace import RecordingPanda, TraceRecorder
 from kwp2000 import KWP2000Client, ECU_IDENTIFICATION_TYPE
+from ccp_dump import Checkpoint, dump, verify
 
 try:
     from panda.ccp import CcpClient, BYTE_ORDER
 except ImportError:
     from panda.python.ccp import CcpClient, BYTE_ORDER
 
-CHUNK_SIZE = 4
-
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--bus", default=0, type=int, help="CAN bus number to use")
-    parser.add_argument("--start-address", default=0, type=int, help="start address")
-    parser.add_argument("--end-address", default=0x5FFFF, type=int, help="end address (inclusive)")
+    parser.add_argument("--start-address", type=int, help="start address (default: 0, or the start of the checkpoint with --resume)")
+    parser.add_argument("--end-address", type=int, help="end address, inclusive (default: 0x5FFFF, or the end of the checkpoint with --resume)")
     parser.add_argument("--output", required=True, help="output file")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted dump from its checkpoint")
+    parser.add_argument("--verify", action="store_true", help="read the dump again and re-read regions that don't match")
+    parser.add_argument("--trace", help="record all CAN frames to this file, can be replayed with can_trace.ReplayPanda")
     args = parser.parse_args()
 
+    checkpoint_path = args.output + ".ckpt"
+    if args.resume:
+        checkpoint = Checkpoint.load(checkpoint_path)
+        if args.start_address not in (None, checkpoint.start_address) or args.end_address not in (None, checkpoint.end_address):
+            parser.error(f"the checkpoint is for {hex(checkpoint.start_address)}-{hex(checkpoint.end_address)}, omit the address flags to resume it")
+        print(f"Resuming dump at {hex(checkpoint.next_address)}")
+    else:
+        start_address = 0 if args.start_address is None else args.start_address
+        end_address = 0x5FFFF if args.end_address is None else args.end_address
+        checkpoint = Checkpoint(checkpoint_path, start_address, end_address)
+
+    # With --resume the address range comes from the checkpoint
+    start_address, end_address = checkpoint.start_address, checkpoint.end_address
+
     p = Panda()
     p.can_clear(0xFFFF)
     p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
 
+    if args.trace is not None:
+        recorder = TraceRecorder(args.trace)
+        atexit.register(recorder.close)
+        p = RecordingPanda(p, recorder)
+
     print("Connecting using KWP2000...")
     tp20 = TP20Transport(p, 0x9, bus=args.bus)
     kwp_client = KWP2000Client(tp20)
@@ -36,19 +59,25 @@ if __name__ == "__main__":
     status = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH)
     print("Flash status", status)
 
+    tp20.close()
+
     print("\nConnecting using CCP...")
     client = CcpClient(p, 1746, 1747, byte_order=BYTE_ORDER.LITTLE_ENDIAN, bus=args.bus)
     client.connect(0x0)
 
-    progress = tqdm.tqdm(total=args.end_address - args.start_address)
+    progress = tqdm.tqdm(total=end_address - start_address + 1, unit="B", unit_scale=True)
 
-    addr = args.start_address
-    client.set_memory_transfer_address(0, 0, addr)
+    with open(args.output, "r+b" if args.resume else "wb") as f:
+        rate = dump(client, f, start_address, end_address, progress, checkpoint)
+        progress.close()
+        print(f"Dumped at {rate:.0f} bytes/s")
 
-    with open(args.output, "wb") as f:
-        while addr < args.end_address:
-            f.write(client.upload(CHUNK_SIZE)[:CHUNK_SIZE])
-            f.flush()
+        if args.verify:
+            print("\nVerifying...")
+            progress = tqdm.tqdm(total=end_address - start_address + 1, unit="B", unit_scale=True)
+            fixed = verify(client, f, checkpoint, progress)
+            progress.close()
 
-            addr += CHUNK_SIZE
-            progress.update(CHUNK_SIZE)
+            for start, end in fixed:
+                print(f"Re-read region {hex(start)}-{hex(end)}")
+            print(f"Verified, {len(fixed)} regions re-read")
@@ -1,90 +1,62 @@
 #!/usr/bin/env python3
-import struct
+import os
+import sys
+import json
 from argparse import ArgumentParser
-import crcmod
 
-# fmt: off
-
-# (addr, orig, new (optional) )
-patches = {
-    "2501": [
-        (0x0005E7A8, b"1K0909144E \x002501", None),  # Software number and version
-        (0x0005E221, b"\x64", b"\x00"),  # Disengage countdown
-        (0x0005E283, b"\x32", b"\x00"),  # Min speed
-        (0x0005FFFC, b"Ende", b"\xff\xff\xff\xff"),  # End of FW marker
-    ],
-    "3501": [
-        (0x0005D828, b"1K0909144R \x003501", None),  # Software number and version
-        (0x0005D289, b"\x64", b"\x00"),  # Disengage countdown
-        (0x0005D2FA, b"\x14", b"\x00"),  # Min speed
-        (0x0005FFFC, b"Ende", b"\xff\xff\xff\xff"),  # End of FW marker
-    ]
-}
-
-# (checksum addr, start, end)
-checksums = {
-    "2501": [
-        (0x05EFFC, 0x5E000, 0x5EFFC),
-    ],
-    "3501": [
-        (0x05DFFC, 0x5C000, 0x5CFFF),
-        (0x05DFFE, 0x5CFFF, 0x5DFFC),
-        (0x05EFFE, 0x5E000, 0x5EFFE),
-    ]
-}
-# fmt: on
-
-
-def crc16(dat):
-    xmodem_crc_func = crcmod.mkCrcFun(0x11021, rev=False, initCrc=0x0000, xorOut=0x0000)
-    crc = xmodem_crc_func(dat)
-    return struct.pack(">H", crc)
-
-
-def verify_checksums(fw_in, config):
-    for expected, start, end in config:
-        if fw_in[expected : expected + 2] != crc16(fw_in[start:end]):
-            return False
-
-    return True
-
-
-def update_checksums(fw_in, config):
-    fw_out = fw_in
-    for expected, start, end in config:
-        fw_out = fw_out[:expected] + crc16(fw_in[start:end]) + fw_out[expected + 2 :]
-    return fw_out
+from batch_patcher import find_inputs, output_paths, run
+from firmware_image import FirmwareImage
+from patch_db import DEFAULT_PATH, apply, load
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
-    parser.add_argument("--input", required=True, help="input file to patch")
-    parser.add_argument("--output", required=True, help="output file")
-    parser.add_argument("--version", default="2501", const="2501", nargs="?", choices=["2501", "3501"])
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--input", help="input file to patch")
+    group.add_argument("--batch", help="directory or manifest of input files to patch")
+    parser.add_argument("--output", required=True, help="output file, or output directory when using --batch")
+    parser.add_argument("--version", help="firmware version, detected from the input by default")
+    parser.add_argument("--patches", default=DEFAULT_PATH, help="patch definitions")
+    parser.add_argument("--jobs", type=int, help="number of images to patch in parallel (default: number of CPUs)")
+    parser.add_argument("--report", help="write a JSON report of the batch to this file")
     args = parser.parse_args()
 
-    with open(args.input, "rb") as input_fw:
-        input_fw_s = input_fw.read()
+    if args.batch is not None:
+        assert args.version is None, "The version is always detected when using --batch"
+
+        jobs = output_paths(find_inputs(args.batch), args.output)
+        for _, output_path in jobs:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+        results = run(jobs, args.patches, args.jobs)
 
-    output_fw_s = input_fw_s
+        failed = [r for r in results if r["error"] is not None]
+        for r in results:
+            print(f"{r['input']}: {r['error'] if r['error'] is not None else r['version']}")
+        print(f"\nPatched {len(results) - len(failed)} of {len(results)} images")
 
-    assert verify_checksums(output_fw_s, checksums[args.version])
+        if args.report is not None:
+            with open(args.report, "w") as f:
+                json.dump(results, f, indent=2)
 
-    for addr, orig, new in patches[args.version]:
-        length = len(orig)
-        cur = input_fw_s[addr : addr + length]
+        sys.exit(1 if failed else 0)
 
-        assert cur == orig, f"Unexpected values in input FW {cur.hex()} expected {orig.hex()}"
+    db = load(args.patches)
 
-        if new is not None:
-            assert len(new) == length
-            output_fw_s = output_fw_s[:addr] + new + output_fw_s[addr + length :]
-            assert output_fw_s[addr : addr + length] == new
+    # The input stays mapped while the output is written
+    assert os.path.abspath(args.input) != os.path.abspath(args.output), "Output would overwrite the input"
 
-    output_fw_s = update_checksums(output_fw_s, checksums[args.version])
+    # Copy on write, only the patched pages are copied
+    image = FirmwareImage.open(args.input, "c")
 
-    assert verify_checksums(output_fw_s, checksums[args.version])
-    assert len(output_fw_s) == len(input_fw_s)
+    if args.version is None:
+        definition = db.detect(image.dat)
+        assert definition is not None, "Unknown firmware version"
+        print(f"Detected {definition.part_number} {definition.software_version}")
+    else:
+        assert args.version in db.versions(), f"Unknown version {args.version}, supported: {', '.join(db.versions())}"
+        definition = db[args.version]
 
-    with open(args.output, "wb") as output_fw:
-        output_fw.write(output_fw_s)
+    apply(image, definition)
+    image.save(args.output)
+    image.close()
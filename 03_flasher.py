@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 import time
+import atexit
 import tqdm
 import sys
 import struct
 from argparse import ArgumentParser
 
 from panda import Panda  # type: ignore
-from tp20 import TP20Transport
+from tp20 import TP20Transport, ChannelClosedError, MessageTimeoutError
+from can_trace import RecordingPanda, TraceRecorder
+from flash_diff import changed_ranges
+from flash_transfer import max_block_size, transfer
+from checksum import sum16
+from firmware_image import FirmwareImage
+from metrics import Metrics
 from kwp2000 import ACCESS_TYPE, ROUTINE_CONTROL_TYPE, KWP2000Client, SESSION_TYPE, ECU_IDENTIFICATION_TYPE
 
-CHUNK_SIZE = 240
-
 
 def compute_key(seed):
     key = seed
@@ -31,14 +36,30 @@ if __name__ == "__main__":
     parser.add_argument("--input", required=True, help="input to flash")
     parser.add_argument("--start-address", default=0x5E000, type=int, help="start address")
     parser.add_argument("--end-address", default=0x5EFFF, type=int, help="end address (inclusive)")
+    parser.add_argument("--diff", help="image currently on the ECU (e.g. the dump), only flash sectors that differ from it")
+    parser.add_argument("--trace", help="record all CAN frames to this file, can be replayed with can_trace.ReplayPanda")
+    parser.add_argument("--metrics", help="write transport and KWP metrics to this file, as Prometheus text if it ends with .prom, JSON otherwise")
     args = parser.parse_args()
 
-    with open(args.input, "rb") as input_fw:
-        input_fw_s = input_fw.read()
+    input_fw = FirmwareImage.open(args.input)
 
     assert args.start_address < args.end_address
-    assert args.end_address < len(input_fw_s)
-    assert input_fw_s[-4:] != b"Ende", "Firmware is not patched"
+    assert args.end_address < len(input_fw)
+    assert input_fw[-4:] != b"Ende", "Firmware is not patched"
+
+    if args.diff is not None:
+        with FirmwareImage.open(args.diff) as current_fw:
+            ranges = changed_ranges(current_fw.dat, input_fw.dat, args.start_address, args.end_address)
+
+        if not ranges:
+            print("No changes to flash")
+            sys.exit(0)
+    else:
+        ranges = [(args.start_address, args.end_address)]
+
+    print("\nRanges to flash:")
+    for start_address, end_address in ranges:
+        print(f"* {hex(start_address)} - {hex(end_address)}")
 
     print("\n[READY TO FLASH]")
     print("WARNING! USE AT YOUR OWN RISK! THIS COULD BREAK YOUR ECU AND REQUIRE REPLACEMENT!")
@@ -53,26 +74,26 @@ if __name__ == "__main__":
     p.can_clear(0xFFFF)
     p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
 
+    if args.trace is not None:
+        recorder = TraceRecorder(args.trace)
+        atexit.register(recorder.close)
+        p = RecordingPanda(p, recorder)
+
+    metrics = Metrics() if args.metrics is not None else None
+    if metrics is not None:
+        atexit.register(metrics.save, args.metrics)
+
     print("Connecting...")
-    tp20 = TP20Transport(p, 0x9, bus=args.bus)
-    kwp_client = KWP2000Client(tp20)
+    tp20 = TP20Transport(p, 0x9, bus=args.bus, metrics=metrics)
+    kwp_client = KWP2000Client(tp20, metrics=metrics)
 
     print("\nEntering programming mode")
     kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
     print("Done. Waiting to reconnect...")
 
-    for i in range(10):
-        time.sleep(1)
-        print(f"\nReconnecting... {i}")
-
-        p.can_clear(0xFFFF)
-        try:
-            tp20 = TP20Transport(p, 0x9, bus=args.bus)
-            break
-        except Exception as e:
-            print(e)
-
-    kwp_client = KWP2000Client(tp20)
+    start = time.monotonic()
+    tp20.reconnect()
+    print(f"Reconnected after {time.monotonic() - start:.2f}s")
 
     print("\nReading ecu identification & flash status")
     ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
@@ -93,60 +114,52 @@ if __name__ == "__main__":
     print("\n Send key")
     kwp_client.security_access(ACCESS_TYPE.PROGRAMMING_SEND_KEY, key)
 
-    print("\nRequest download")
-    size = args.end_address - args.start_address + 1
-    chunk_size = kwp_client.request_download(args.start_address, size)
-    print(f"Chunk size: {chunk_size}")
-    assert chunk_size >= CHUNK_SIZE, "Chosen chunk size too large"
-
-    print("\nErase flash")
-    f_routine = kwp_client.erase_flash(args.start_address, args.end_address)
-    print("F_routine", f_routine)
-    print("Done. Waiting to reconnect...")
+    for start_address, end_address in ranges:
+        print(f"\nRequest download {hex(start_address)} - {hex(end_address)}")
+        size = end_address - start_address + 1
+        max_block_length = kwp_client.request_download(start_address, size)
+        block_size = max_block_size(max_block_length)
+        print(f"Max block length: {max_block_length}, block size: {block_size}")
 
-    for i in range(10):
-        time.sleep(1)
-        print(f"\nReconnecting... {i}")
+        print("\nErase flash")
+        f_routine = kwp_client.erase_flash(start_address, end_address)
+        print("F_routine", f_routine)
 
-        p.can_clear(0xFFFF)
+        print("\nRequest erase results")
         try:
-            tp20 = TP20Transport(p, 0x9, bus=args.bus)
-            break
-        except Exception as e:
-            print(e)
+            result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH)
+        except (MessageTimeoutError, ChannelClosedError):
+            print("Channel lost during erase. Waiting to reconnect...")
 
-    kwp_client = KWP2000Client(tp20)
+            start = time.monotonic()
+            tp20.reconnect()
+            print(f"Reconnected after {time.monotonic() - start:.2f}s")
 
-    print("\nRequest erase results")
-    result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH)
-    assert result == b"\x00", "Erase failed"
+            result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH)
 
-    print("\nTransfer data")
-    to_flash = input_fw_s[args.start_address : args.end_address + 1]
-    checksum = sum(to_flash) & 0xFFFF
+        assert result == b"\x00", "Erase failed"
 
-    progress = tqdm.tqdm(total=len(to_flash))
+        print("\nTransfer data")
+        to_flash = input_fw.view(start_address, end_address)
+        checksum = sum16(to_flash)
 
-    while to_flash:
-        chunk = to_flash[:CHUNK_SIZE]
-        kwp_client.transfer_data(chunk)
+        progress = tqdm.tqdm(total=len(to_flash))
 
-        # Keep channel alive
-        tp20.can_send(b"\xa3")
-        tp20.can_recv()
+        used_block_size = transfer(kwp_client, to_flash, block_size, progress)
+        progress.close()
 
-        to_flash = to_flash[CHUNK_SIZE:]
-        progress.update(CHUNK_SIZE)
+        if used_block_size != block_size:
+            print(f"Block size reduced to {used_block_size}")
 
-    print("\nRequest transfer exit")
-    kwp_client.request_transfer_exit()
+        print("\nRequest transfer exit")
+        kwp_client.request_transfer_exit()
 
-    print("\nStart checksum check")
-    kwp_client.calculate_flash_checksum(args.start_address, args.end_address, checksum)
+        print("\nStart checksum check")
+        kwp_client.calculate_flash_checksum(start_address, end_address, checksum)
 
-    print("\nRequest checksum results")
-    result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM)
-    assert result == b"\x00", "Checksum check failed"
+        print("\nRequest checksum results")
+        result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM)
+        assert result == b"\x00", "Checksum check failed"
 
     print("\nStop communication")
     kwp_client.stop_communication()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Patch many firmware images in parallel
+"""
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from firmware_image import FirmwareImage
+from patch_db import DEFAULT_PATH, apply, load
+
+
+def find_inputs(path: str) -> List[str]:
+    """All .bin files in a directory, or the files listed in a manifest
+    (one per line, relative to the manifest, # starts a comment)"""
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".bin"))
+
+    inputs = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                inputs.append(os.path.join(os.path.dirname(path), line))
+    return inputs
+
+
+def output_paths(inputs: List[str], output_dir: str) -> List[Tuple[str, str]]:
+    """Pair every input with an output under output_dir. The path relative
+    to the inputs' common directory is kept, so inputs with the same name
+    in different directories don't overwrite each other."""
+    if not inputs:
+        return []
+
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in inputs])
+    jobs = [(path, os.path.join(output_dir, os.path.relpath(os.path.abspath(path), base))) for path in inputs]
+
+    seen = set()
+    for input_path, output_path in jobs:
+        if output_path in seen:
+            raise ValueError(f"{input_path} is listed more than once")
+        if os.path.abspath(input_path) == os.path.abspath(output_path):
+            raise ValueError(f"{input_path} would be overwritten")
+        seen.add(output_path)
+
+    return jobs
+
+
+def patch_file(input_path: str, output_path: str, patches_path: str = DEFAULT_PATH) -> dict:
+    """Detect the version of input_path and write the patched image to
+    output_path. The output is a copy of the input that is patched through
+    a memory map, so the image is never read into memory as a whole."""
+    result: dict = {"input": input_path, "output": output_path, "version": None, "error": None}
+
+    created = False
+    try:
+        with FirmwareImage.open(input_path) as fw_in:
+            definition = load(patches_path).detect(fw_in.dat)
+
+        if definition is None:
+            raise ValueError("Unknown firmware version")
+        result["version"] = definition.version
+
+        shutil.copyfile(input_path, output_path)
+        created = True
+
+        with FirmwareImage.open(output_path, "r+") as fw:
+            apply(fw, definition)
+            fw.flush()
+    except Exception as e:
+        result["error"] = str(e) or type(e).__name__
+        if created:
+            os.remove(output_path)
+
+    return result
+
+
+def run(jobs: List[Tuple[str, str]], patches_path: str = DEFAULT_PATH, workers: Optional[int] = None) -> List[dict]:
+    """Patch every (input, output) pair using a process per CPU core"""
+    if not jobs:
+        return []
+
+    inputs, outputs = zip(*jobs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(patch_file, inputs, outputs, [patches_path] * len(jobs)))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Record CAN frames to a compact binary trace, and replay them
+"""
+
+import time
+import struct
+import threading
+from typing import Iterator, List, Tuple
+
+MAGIC = b"PQTRACE1"
+
+# Magic, wall clock time of the first record, reserved. Same size as a
+# record, so the records of a file can be mapped as an array.
+HEADER = struct.Struct("<8sdQ")
+
+# Seconds since the start of the trace, addr, bus, direction, length, data
+RECORD = struct.Struct("<dIBBBx8s")
+
+RX = 0
+TX = 1
+
+# Number of records buffered before they are written by the flush thread
+RING_SIZE = 4096
+
+# Time between flushes of the ring buffer
+FLUSH_INTERVAL = 0.1
+
+# (timestamp, direction, addr, bus, dat)
+Record = Tuple[float, int, int, int, bytes]
+
+
+class TraceRecorder:
+    def __init__(self, path: str, capacity: int = RING_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        """Records are packed into a preallocated ring buffer, a background
+        thread appends them to the file. When the ring buffer is full,
+        records are dropped and counted instead of blocking the caller."""
+        self.f = open(path, "wb")
+        self.f.write(HEADER.pack(MAGIC, time.time(), 0))
+        self.start = time.monotonic()
+
+        self.capacity = capacity
+        self.ring = bytearray(capacity * RECORD.size)
+        self.head = 0  # Total number of records written to the ring
+        self.tail = 0  # Total number of records flushed to the file
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+        self.flush_interval = flush_interval
+        self.running = True
+        self.wakeup = threading.Event()
+        self.flush_thread = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flush_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, direction: int, addr: int, dat: bytes, bus: int):
+        t = time.monotonic() - self.start
+        with self.lock:
+            if self.head - self.tail >= self.capacity:
+                self.dropped += 1
+                return
+
+            RECORD.pack_into(self.ring, (self.head % self.capacity) * RECORD.size, t, addr, bus, direction, len(dat), bytes(dat))
+            self.head += 1
+
+            if self.head - self.tail == self.capacity // 2:
+                self.wakeup.set()
+
+    def flush(self):
+        """Write the records in the ring buffer to the file. Records between
+        tail and head are not touched by record(), so the lock is only held
+        to read and update the indices."""
+        with self.flush_lock:
+            with self.lock:
+                head, tail = self.head, self.tail
+
+            if head == tail:
+                return
+
+            start, end = tail % self.capacity, head % self.capacity
+            if start < end:
+                self.f.write(self.ring[start * RECORD.size : end * RECORD.size])
+            else:
+                self.f.write(self.ring[start * RECORD.size :])
+                self.f.write(self.ring[: end * RECORD.size])
+            self.f.flush()
+
+            with self.lock:
+                self.tail = head
+
+    def flush_loop(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        if not self.running:
+            return
+
+        self.running = False
+        self.wakeup.set()
+        self.flush_thread.join()
+        self.flush()
+        self.f.close()
+
+
+class RecordingPanda:
+    def __init__(self, panda, recorder: TraceRecorder):
+        """Wraps a panda and records every frame that is sent or received"""
+        self.panda = panda
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.panda, name)
+
+    def can_send(self, addr, dat, bus, *args, **kwargs):
+        self.recorder.record(TX, addr, dat, bus)
+        return self.panda.can_send(addr, dat, bus, *args, **kwargs)
+
+    def can_send_many(self, arr, *args, **kwargs):
+        for addr, _, dat, bus in arr:
+            self.recorder.record(TX, addr, dat, bus)
+        return self.panda.can_send_many(arr, *args, **kwargs)
+
+    def can_recv(self):
+        msgs = self.panda.can_recv()
+        for addr, _, dat, bus in msgs:
+            self.recorder.record(RX, addr, dat, bus)
+        return msgs
+
+
+def read_trace(path: str) -> Iterator[Record]:
+    with open(path, "rb") as f:
+        magic, _, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a trace")
+
+        while True:
+            buf = f.read(RECORD.size * 1024)
+            for t, addr, bus, direction, length, dat in RECORD.iter_unpack(buf[: len(buf) - len(buf) % RECORD.size]):
+                yield t, direction, addr, bus, dat[:length]
+
+            if len(buf) < RECORD.size * 1024:
+                return
+
+
+class ReplayPanda:
+    def __init__(self, path: str, speed: float = 1.0):
+        """Returns the received frames of a trace from can_recv. Frames that
+        were received after the n-th sent frame are returned once n frames
+        were sent, after the same delay as in the trace divided by speed.
+        The replay follows the client, even when it's faster or slower than
+        the recorded session, as long as it uses the same transport settings
+        (e.g. keepalives disabled). Use speed=0 to replay without delays."""
+        self.speed = speed
+
+        # Received frames per number of frames sent before them, with their delay
+        self.rx: List[List[Tuple[float, Tuple[int, int, bytes, int]]]] = [[]]
+        last_tx = 0.0
+        for t, direction, addr, bus, dat in read_trace(path):
+            if direction == TX:
+                self.rx.append([])
+                last_tx = t
+            else:
+                self.rx[-1].append((t - last_tx, (addr, 0, dat, bus)))
+
+        self.lock = threading.Lock()
+        self.tx_count = 0
+        self.tx_time = time.monotonic()
+        self.idx = 0
+        self.sent: List[Tuple[int, bytes]] = []
+
+    def set_safety_mode(self, mode):
+        pass
+
+    def can_clear(self, bus):
+        pass
+
+    def can_send(self, addr, dat, bus, timeout=0):
+        with self.lock:
+            self.sent.append((addr, bytes(dat)))
+
+            # Everything before this frame was already received in the trace
+            if self.tx_count + 1 < len(self.rx):
+                self.tx_count += 1
+                self.idx = 0
+                self.tx_time = time.monotonic()
+
+    def can_send_many(self, arr, timeout=0):
+        for addr, _, dat, bus in arr:
+            self.can_send(addr, dat, bus, timeout)
+
+    def can_recv(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.tx_time
+            frames = self.rx[self.tx_count]
+
+            msgs = []
+            while self.idx < len(frames):
+                delay, msg = frames[self.idx]
+                if self.speed > 0 and delay / self.speed > elapsed:
+                    break
+                msgs.append(msg)
+                self.idx += 1
+            return msgs
+
+    def done(self) -> bool:
+        """True when every received frame of the trace was returned"""
+        with self.lock:
+            return self.tx_count == len(self.rx) - 1 and self.idx == len(self.rx[-1])
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Read ECU memory over CCP
+"""
+
+import os
+import json
+import time
+import zlib
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+# An UPLOAD reply (DTO) has room for at most 5 data bytes. CCP has no
+# block transfer mode, so this is the largest read per round trip.
+MAX_UPLOAD_SIZE = 5
+
+# Dumps are checkpointed and verified in regions of this size
+REGION_SIZE = 0x1000
+
+# Number of times a region is read during verification
+# before giving up on getting two identical reads
+MAX_VERIFY_READS = 5
+
+
+class Checkpoint:
+    def __init__(self, path: str, start_address: int, end_address: int, region_size: int = REGION_SIZE):
+        """Sidecar file of a dump, containing the first address that was not
+        written yet and the CRC32 of every region that was written."""
+        self.path = path
+        self.start_address = start_address
+        self.end_address = end_address
+        self.region_size = region_size
+        self.next_address = start_address
+        self.crcs: List[int] = []
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint":
+        with open(path) as f:
+            dat = json.load(f)
+
+        checkpoint = cls(path, dat["start_address"], dat["end_address"], dat["region_size"])
+        checkpoint.next_address = dat["next_address"]
+        checkpoint.crcs = dat["crcs"]
+        return checkpoint
+
+    def save(self):
+        """Write to a temporary file first, so a checkpoint
+        is never half written when the dump is interrupted"""
+        dat = {
+            "start_address": self.start_address,
+            "end_address": self.end_address,
+            "region_size": self.region_size,
+            "next_address": self.next_address,
+            "crcs": self.crcs,
+        }
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(dat, f)
+        os.replace(tmp, self.path)
+
+    def regions(self, start_address: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+        """Yields (start, end) of every region, end is inclusive"""
+        if start_address is None:
+            start_address = self.start_address
+
+        for start in range(start_address, self.end_address + 1, self.region_size):
+            yield start, min(start + self.region_size - 1, self.end_address)
+
+
+def read(client, start_address: int, end_address: int, progress=None) -> bytearray:
+    """Read start_address up to and including end_address
+    using the largest uploads possible"""
+    client.set_memory_transfer_address(0, 0, start_address)
+
+    buf = bytearray()
+    addr = start_address
+    while addr <= end_address:
+        size = min(MAX_UPLOAD_SIZE, end_address - addr + 1)
+        buf += client.upload(size)[:size]
+        addr += size
+
+        if progress is not None:
+            progress.update(size)
+
+    return buf
+
+
+def dump(client, f: BinaryIO, start_address: int, end_address: int, progress=None, checkpoint: Optional[Checkpoint] = None) -> float:
+    """Read start_address up to and including end_address into f one region
+    at a time. With a checkpoint the dump continues at the last confirmed
+    address, and the checkpoint is updated after every region.
+    Returns the throughput in bytes/s"""
+    if checkpoint is None:
+        checkpoint = Checkpoint(os.devnull, start_address, end_address)
+        save = False
+    else:
+        assert (checkpoint.start_address, checkpoint.end_address) == (start_address, end_address), "Checkpoint is for a different address range"
+        save = True
+
+    resume_address = checkpoint.next_address
+    if progress is not None:
+        progress.update(resume_address - start_address)
+
+    f.seek(resume_address - start_address)
+    f.truncate()
+
+    start_time = time.monotonic()
+    for start, end in checkpoint.regions(resume_address):
+        region = read(client, start, end, progress)
+        f.write(region)
+
+        checkpoint.crcs.append(zlib.crc32(region))
+        checkpoint.next_address = end + 1
+        if save:
+            f.flush()
+            checkpoint.save()
+
+    elapsed = time.monotonic() - start_time
+    return (end_address + 1 - resume_address) / elapsed if elapsed > 0 else 0.0
+
+
+def verify(client, f: BinaryIO, checkpoint: Checkpoint, progress=None) -> List[Tuple[int, int]]:
+    """Read every region again and compare it to the CRC in the checkpoint.
+    Regions that don't match are read until two reads are identical, and
+    are then rewritten. Returns the regions that were rewritten."""
+    assert checkpoint.next_address > checkpoint.end_address, "Dump is not complete"
+
+    fixed = []
+    for i, (start, end) in enumerate(checkpoint.regions()):
+        region = read(client, start, end, progress)
+        crc = zlib.crc32(region)
+        if crc == checkpoint.crcs[i]:
+            continue
+
+        for _ in range(MAX_VERIFY_READS):
+            prev_crc = crc
+            region = read(client, start, end)
+            crc = zlib.crc32(region)
+            if crc == prev_crc:
+                break
+        else:
+            raise RuntimeError(f"Region {hex(start)}-{hex(end)} does not read back consistently")
+
+        f.seek(start - checkpoint.start_address)
+        f.write(region)
+        f.flush()
+
+        checkpoint.crcs[i] = crc
+        checkpoint.save()
+        fixed.append((start, end))
+
+    return fixed
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+CRC16 checksums of the firmware calibration areas
+"""
+
+import struct
+import functools
+from typing import List, Tuple
+
+import crcmod  # type: ignore
+
+try:
+    import numpy as np  # type: ignore
+except ImportError:
+    np = None  # type: ignore
+
+# CRC-16/XMODEM, used for all checksums in the firmware
+XMODEM_POLY = 0x11021
+
+# (checksum addr, start, end), end is exclusive
+ChecksumConfig = List[Tuple[int, int, int]]
+
+
+@functools.lru_cache(maxsize=None)
+def crc_function(poly: int, init_crc: int = 0x0000, xor_out: int = 0x0000):
+    """Building the table is much slower than computing
+    a checksum, so every CRC function is only built once"""
+    return crcmod.mkCrcFun(poly, rev=False, initCrc=init_crc, xorOut=xor_out)
+
+
+def crc16(dat) -> bytes:
+    return struct.pack(">H", crc_function(XMODEM_POLY)(dat))
+
+
+def sum16(dat) -> int:
+    """Sum of all bytes truncated to 16 bits, as used by the flash checksum routine"""
+    if np is not None:
+        return int(np.frombuffer(dat, dtype=np.uint8).sum(dtype=np.uint64)) & 0xFFFF
+    return sum(dat) & 0xFFFF
+
+
+def _mulmod(a: int, b: int, poly: int) -> int:
+    """Multiply two polynomials over GF(2) modulo poly"""
+    width = poly.bit_length() - 1
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a >> width:
+            a ^= poly
+    return result
+
+
+@functools.lru_cache(maxsize=1024)
+def _xpow(n: int, poly: int) -> int:
+    """x^n modulo poly"""
+    result, base = 1, 2
+    while n:
+        if n & 1:
+            result = _mulmod(result, base, poly)
+        base = _mulmod(base, base, poly)
+        n >>= 1
+    return result
+
+
+def crc_update(crc: int, length: int, offset: int, old: bytes, new: bytes, poly: int = XMODEM_POLY) -> int:
+    """Returns the CRC of a message of length bytes with checksum crc, after
+    old at offset was replaced by new. Only the changed bytes are processed.
+
+    The CRC is linear, so the difference between both messages is the CRC
+    of old ^ new followed by zeroes up to the end of the message. Appending
+    n zero bytes is the same as multiplying by x^(8 * n) modulo poly."""
+    assert len(old) == len(new)
+    assert offset + len(new) <= length
+
+    delta = bytes(a ^ b for a, b in zip(old, new))
+    delta_crc = crc_function(poly)(delta)
+
+    zeroes = length - offset - len(delta)
+    return crc ^ _mulmod(delta_crc, _xpow(8 * zeroes, poly), poly)
+
+
+def compute_checksums(fw, config: ChecksumConfig) -> List[bytes]:
+    with memoryview(fw) as view:
+        return [crc16(view[start:end]) for _, start, end in config]
+
+
+def verify_checksums(fw, config: ChecksumConfig) -> bool:
+    for (expected, _, _), crc in zip(config, compute_checksums(fw, config)):
+        if fw[expected : expected + 2] != crc:
+            return False
+
+    return True
+
+
+def update_checksums(fw: bytearray, config: ChecksumConfig):
+    """All checksums are computed before any is written, so a checksum
+    stored inside another region doesn't affect the result"""
+    for (expected, _, _), crc in zip(config, compute_checksums(fw, config)):
+        fw[expected : expected + 2] = crc
+
+
+def update_changed_checksums(fw: bytearray, changes: List[Tuple[int, bytes, bytes]], config: ChecksumConfig) -> ChecksumConfig:
+    """Update the checksum of every region that contains one of the changes
+    (addr, old, new) incrementally. The changes have to be written to fw
+    already, in order, and the stored checksums have to be valid from
+    before the first change. Returns the regions that were updated."""
+    updated = []
+    crcs = []
+    for expected, start, end in config:
+        crc = struct.unpack(">H", fw[expected : expected + 2])[0]
+        changed = False
+
+        for addr, old, new in changes:
+            assert not (addr < expected + 2 and expected < addr + len(new)), "Patch overlaps checksum"
+
+            # Part of the change inside this region
+            lo, hi = max(addr, start), min(addr + len(new), end)
+            if lo >= hi:
+                continue
+
+            crc = crc_update(crc, end - start, lo - start, old[lo - addr : hi - addr], new[lo - addr : hi - addr])
+            changed = True
+
+        if changed:
+            updated.append((expected, start, end))
+            crcs.append(crc)
+
+    # All checksums are computed before any is written, like update_checksums
+    for (expected, _, _), crc in zip(updated, crcs):
+        fw[expected : expected + 2] = struct.pack(">H", crc)
+
+    return updated
+
+
+def patch(fw: bytearray, addr: int, new: bytes, config: ChecksumConfig):
+    """Write new at addr and update the checksum of every region that
+    contains it incrementally. The stored checksums have to be valid."""
+    old = bytes(fw[addr : addr + len(new)])
+    fw[addr : addr + len(new)] = new
+    update_changed_checksums(fw, [(addr, old, bytes(new))], config)
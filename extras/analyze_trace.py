@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of TP 2.0 / KWP2000 sessions in a CAN trace recorded with
+--trace, or a candump log. The trace is memory mapped and processed in
+chunks, so files larger than RAM can be analyzed. The frames of a chunk are
+filtered using numpy, only frames on 0x200 - 0x2FF and on the addresses of
+the opened channels are decoded one by one.
+
+Reports the latency of every KWP service, retransmitted frames and negative
+response codes as JSON.
+"""
+
+import sys
+import json
+import struct
+from argparse import ArgumentParser
+from collections import defaultdict
+from typing import DefaultDict, Dict, List, Optional, Set, Tuple
+
+import numpy as np  # type: ignore
+import tqdm
+
+from can_trace import HEADER, MAGIC, RECORD, RX
+from kwp2000 import RESPONSE_PENDING, SERVICE_TYPE, _negative_response_codes
+from tp20 import BROADCAST_ADDR
+
+# Same layout as can_trace.RECORD
+TRACE_DTYPE = np.dtype(
+    [
+        ("t", "<f8"),
+        ("addr", "<u4"),
+        ("bus", "u1"),
+        ("direction", "u1"),
+        ("length", "u1"),
+        ("pad", "u1"),
+        ("dat", "u1", (8,)),
+    ]
+)
+assert TRACE_DTYPE.itemsize == RECORD.size
+
+# Number of records processed at once
+CHUNK_RECORDS = 1 << 20
+
+
+def open_trace(path: str) -> np.ndarray:
+    with open(path, "rb") as f:
+        magic, _, _ = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a trace")
+
+    return np.memmap(path, dtype=TRACE_DTYPE, mode="r", offset=HEADER.size)
+
+
+def convert_candump(src: str, dst: str) -> int:
+    """Convert a candump log (candump -l) to a trace, returns the number of
+    frames. Interfaces are numbered as buses in the order they appear."""
+    buses: Dict[str, int] = {}
+    start = None
+    count = 0
+
+    with open(src) as f_in, open(dst, "wb") as f_out:
+        f_out.write(HEADER.pack(MAGIC, 0.0, 0))
+
+        for line in f_in:
+            # (1436509052.249713) can0 200#09C00010000301
+            parts = line.split()
+            if len(parts) < 3 or "#" not in parts[2]:
+                continue
+
+            addr, dat = parts[2].split("#", 1)
+            if dat.startswith(("#", "R")):  # CAN FD or remote frame
+                continue
+
+            t = float(parts[0].strip("()"))
+            if start is None:
+                start = t
+                f_out.seek(0)
+                f_out.write(HEADER.pack(MAGIC, start, 0))
+                f_out.seek(0, 2)
+
+            dat_bytes = bytes.fromhex(dat)
+            bus = buses.setdefault(parts[1], len(buses))
+            f_out.write(RECORD.pack(t - start, int(addr, 16), bus, RX, len(dat_bytes), dat_bytes))
+            count += 1
+
+    return count
+
+
+class Reassembly:
+    def __init__(self):
+        """Reassembles the messages sent by one side of a channel the same way
+        the receiver does. After a missing frame, frames are dropped until the
+        sender retransmits starting at the missing frame. When the sender goes
+        back to a frame that was already received, the message is rewound to
+        that frame. Messages are only returned without gaps."""
+        self.chunks: List[bytes] = []
+        self.start = 0.0
+        self.expected: Optional[int] = None
+        self.missing = False
+        self.resume: Optional[int] = None  # Sequence number after a dropped last frame
+        self.retransmissions = 0
+        self.gaps = 0
+
+    def feed(self, t: float, dat: bytes) -> Optional[bytes]:
+        """Add a data frame, returns the message when it's complete"""
+        typ, seq = dat[0] >> 4, dat[0] & 0xF
+
+        if self.expected is not None and seq != self.expected:
+            behind = (self.expected - seq) & 0xF
+
+            if self.missing and seq == self.resume:
+                # The sender continued with the next message, so the missing
+                # frame was only lost from the trace. The message is dropped.
+                self.missing = False
+                self.resume = None
+                self.chunks = []
+            elif behind <= 8:
+                if self.missing:
+                    return None
+
+                self.retransmissions += 1
+                if behind > len(self.chunks):
+                    # Retransmission of the end of a message that was already complete
+                    return None
+                del self.chunks[len(self.chunks) - behind :]
+            else:
+                if not self.missing:
+                    self.gaps += 1
+                    self.missing = True
+                self.resume = (seq + 1) & 0xF if typ in (0x1, 0x3) else None
+                return None
+        elif self.missing:
+            # Retransmission starting at the missing frame
+            self.missing = False
+            self.resume = None
+            self.retransmissions += 1
+
+        if not self.chunks:
+            self.start = t
+        self.chunks.append(dat[1:])
+        self.expected = (seq + 1) & 0xF
+
+        if typ not in (0x1, 0x3):
+            return None
+
+        payload = b"".join(self.chunks)
+        self.chunks = []
+        length = struct.unpack(">H", payload[:2])[0]
+        return payload[2 : 2 + length]
+
+
+class Channel:
+    def __init__(self, module: int, tester_addr: int, ecu_addr: int, start: float):
+        self.module = module
+        self.tester_addr = tester_addr
+        self.ecu_addr = ecu_addr
+        self.start = start
+        self.end = start
+        self.closed = False
+        self.keepalives = 0
+        self.requests = 0
+        self.tx = Reassembly()
+        self.rx = Reassembly()
+
+        # Start time and service of the request waiting for a response
+        self.pending: Optional[Tuple[float, int]] = None
+
+    def result(self) -> dict:
+        return {
+            "module": self.module,
+            "tester_addr": self.tester_addr,
+            "ecu_addr": self.ecu_addr,
+            "start": self.start,
+            "end": self.end,
+            "closed": self.closed,
+            "requests": self.requests,
+            "keepalives": self.keepalives,
+            "retransmissions": self.tx.retransmissions + self.rx.retransmissions,
+            "gaps": self.tx.gaps + self.rx.gaps,
+        }
+
+
+def service_name(sid: int) -> str:
+    try:
+        return SERVICE_TYPE(sid).name
+    except ValueError:
+        return hex(sid)
+
+
+def nrc_name(code: int) -> str:
+    return f"{hex(code)} {_negative_response_codes.get(code, 'unknown')}"
+
+
+class Analyzer:
+    def __init__(self, bus: Optional[int] = None):
+        self.bus = bus
+        self.records = 0
+        self.frame_types: DefaultDict[str, int] = defaultdict(int)
+        self.channel_addrs: Set[int] = set()
+        self.channels: Dict[int, Channel] = {}
+        self.sessions: List[Channel] = []
+        self.latencies: DefaultDict[str, List[float]] = defaultdict(list)
+        self.errors: DefaultDict[str, int] = defaultdict(int)
+        self.nrcs: DefaultDict[str, int] = defaultdict(int)
+
+    def feed_chunk(self, records: np.ndarray):
+        self.records += len(records)
+
+        addr = records["addr"]
+        dat = records["dat"]
+        broadcast = (addr >= BROADCAST_ADDR) & (addr <= BROADCAST_ADDR + 0xFF)
+        if self.bus is not None:
+            broadcast &= records["bus"] == self.bus
+
+        # Addresses of the channels opened in this chunk, from the setup responses
+        setup = dat[broadcast & (addr > BROADCAST_ADDR) & (dat[:, 1] == 0xD0)]
+        self.channel_addrs.update((setup[:, 2] | (setup[:, 3].astype(np.uint32) << 8)).tolist())
+        self.channel_addrs.update((setup[:, 4] | (setup[:, 5].astype(np.uint32) << 8)).tolist())
+
+        on_channel = np.isin(addr, np.fromiter(self.channel_addrs, dtype=np.uint32, count=len(self.channel_addrs)))
+        if self.bus is not None:
+            on_channel &= records["bus"] == self.bus
+
+        typ = dat[on_channel, 0] >> 4
+        counts = np.bincount(typ, minlength=0x10)
+        self.frame_types["data"] += int(counts[:4].sum())
+        self.frame_types["ack"] += int(counts[0x9] + counts[0xB])
+        self.frame_types["parameters"] += int(counts[0xA])
+        self.frame_types["broadcast"] += int(broadcast.sum())
+
+        selected = records[broadcast | on_channel]
+        for t, a, n, d in zip(selected["t"].tolist(), selected["addr"].tolist(), selected["length"].tolist(), selected["dat"].tolist()):
+            self.feed(t, a, bytes(d[:n]))
+
+    def feed(self, t: float, addr: int, dat: bytes):
+        if not dat:
+            return
+
+        if BROADCAST_ADDR < addr <= BROADCAST_ADDR + 0xFF:
+            # Channel setup response (e.g. 00d00003a80701)
+            if len(dat) == 7 and dat[1] == 0xD0:
+                _, rx, tx, _ = struct.unpack("<xBHHB", dat)
+                session = Channel(addr - BROADCAST_ADDR, tx, rx, t)
+                self.channels[tx] = self.channels[rx] = session
+                self.sessions.append(session)
+            return
+
+        channel = self.channels.get(addr)
+        if channel is None or channel.closed:
+            return
+
+        channel.end = t
+        typ = dat[0] >> 4
+
+        if dat[0] == 0xA8:
+            channel.closed = True
+        elif dat[0] == 0xA3:
+            channel.keepalives += 1
+        elif typ <= 0x3:
+            if addr == channel.tester_addr:
+                msg = channel.tx.feed(t, dat)
+                if msg:
+                    channel.requests += 1
+                    channel.pending = (channel.tx.start, msg[0])
+            else:
+                msg = channel.rx.feed(t, dat)
+                if msg:
+                    self.response(channel, t, msg)
+
+    def response(self, channel: Channel, t: float, msg: bytes):
+        if channel.pending is None:
+            return
+
+        start, sid = channel.pending
+        if msg[0] == 0x7F and len(msg) >= 3:
+            self.nrcs[nrc_name(msg[2])] += 1
+            if msg[2] == RESPONSE_PENDING:
+                return
+            self.errors[service_name(sid)] += 1
+        elif msg[0] != sid + 0x40:
+            return
+
+        # From the first frame of the request to the last frame of the final response
+        self.latencies[service_name(sid)].append(t - start)
+        channel.pending = None
+
+    def result(self) -> dict:
+        services = {}
+        for name, latencies in self.latencies.items():
+            latency = np.array(latencies)
+            services[name] = {
+                "count": len(latencies),
+                "errors": self.errors.get(name, 0),
+                "mean": float(latency.mean()),
+                "p50": float(np.percentile(latency, 50)),
+                "p99": float(np.percentile(latency, 99)),
+                "max": float(latency.max()),
+            }
+
+        sessions = [channel.result() for channel in self.sessions]
+        return {
+            "records": self.records,
+            "frames": dict(self.frame_types),
+            "retransmissions": sum(s["retransmissions"] for s in sessions),
+            "nrcs": dict(self.nrcs),
+            "services": services,
+            "sessions": sessions,
+        }
+
+
+def analyze(path: str, bus: Optional[int] = None, chunk_records: int = CHUNK_RECORDS, progress: bool = False) -> dict:
+    records = open_trace(path)
+    analyzer = Analyzer(bus)
+
+    chunks = range(0, len(records), chunk_records)
+    for offset in tqdm.tqdm(chunks, unit="chunk", disable=not progress):
+        analyzer.feed_chunk(records[offset : offset + chunk_records])
+
+    return analyzer.result()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("input", help="trace recorded with --trace, or a candump log with --candump")
+    parser.add_argument("--candump", action="store_true", help="the input is a candump log, it's converted to <input>.trace first")
+    parser.add_argument("--bus", type=int, help="only analyze frames on this bus")
+    parser.add_argument("--output", help="write the report as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    path = args.input
+    if args.candump:
+        path = args.input + ".trace"
+        print(f"Converted {convert_candump(args.input, path)} frames to {path}", file=sys.stderr)
+
+    report = analyze(path, args.bus, progress=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for TP20Transport.can_recv. Replays a synthetic capture of a
+busy powertrain bus where every poll of the panda returns hundreds of frames
+on unrelated addresses and buses next to the single frame we are waiting for.
+Also reports the CPU used while blocked waiting on an idle bus.
+"""
+import time
+import random
+from argparse import ArgumentParser
+from typing import Optional
+
+from tp20 import TP20Transport, MessageTimeoutError
+
+RX_ADDR = 0x300
+
+
+class ReplayPanda:
+    """Returns each poll of the capture once after start() is called,
+    and an idle bus before and after"""
+
+    def __init__(self, polls):
+        self.polls = polls
+        self.idx = 0
+        self.started = False
+
+    def start(self):
+        self.started = True
+
+    def can_recv(self):
+        if not self.started or self.idx >= len(self.polls):
+            return []
+        msgs = self.polls[self.idx]
+        self.idx += 1
+        return msgs
+
+    def can_send(self, addr, dat, bus, timeout=0):
+        pass
+
+
+class BenchTransport(TP20Transport):
+    def open_channel(self, module: int, setup_timeout: Optional[float] = None):
+        self.tx_addr = 0x740
+
+
+def synthetic_capture(num_polls, frames_per_poll, seed=0):
+    """Each poll contains frames_per_poll frames on random addresses and
+    buses, with one frame for RX_ADDR on bus 0 at a random position"""
+    rng = random.Random(seed)
+    addrs = [a for a in range(0x080, 0x7FF, 7) if a != RX_ADDR]
+
+    polls = []
+    for _ in range(num_polls):
+        msgs = [(rng.choice(addrs), 0, bytes(rng.getrandbits(8) for _ in range(8)), rng.randint(0, 2)) for _ in range(frames_per_poll - 1)]
+        msgs.insert(rng.randrange(frames_per_poll), (RX_ADDR, 0, b"\x10\x00\x02\x5a\x9b", 0))
+        polls.append(msgs)
+    return polls
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--polls", default=5000, type=int, help="number of panda polls in the capture")
+    parser.add_argument("--frames-per-poll", default=500, type=int, help="frames returned per panda poll")
+    parser.add_argument("--idle", default=1.0, type=float, help="seconds to block on an idle bus")
+    args = parser.parse_args()
+
+    panda = ReplayPanda(synthetic_capture(args.polls, args.frames_per_poll))
+    tp20 = BenchTransport(panda, 0x9, timeout=1.0)
+
+    start = time.perf_counter()
+    panda.start()
+    for _ in range(args.polls):
+        tp20.can_recv()
+    elapsed = time.perf_counter() - start
+
+    frames = args.polls * args.frames_per_poll
+    print(f"{args.polls} can_recv calls, {frames} frames replayed in {elapsed:.3f}s")
+    print(f"{elapsed / args.polls * 1e6:.1f} us per can_recv, {frames / elapsed / 1e6:.2f} M frames/s")
+
+    tp20.timeout = args.idle
+    cpu_start = time.process_time()
+    try:
+        tp20.can_recv()
+    except MessageTimeoutError:
+        pass
+    cpu = time.process_time() - cpu_start
+    print(f"CPU time while blocked on idle bus for {args.idle:.1f}s: {cpu * 1000:.1f} ms ({cpu / args.idle * 100:.1f}%)")
+
+    tp20.close()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the dump, patch and flash flows against the simulated
+ECU. Reports throughput, the time spent in every phase of the flow, the
+latency of every KWP service and the transport metrics. Results are written
+as JSON, so runs with different transport parameters can be compared.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import importlib
+from contextlib import contextmanager
+from argparse import ArgumentParser
+from typing import Dict
+
+from ccp_dump import dump
+from checksum import sum16, update_checksums
+from firmware_image import FirmwareImage
+from flash_transfer import max_block_size, transfer
+from kwp2000 import ACCESS_TYPE, ECU_IDENTIFICATION_TYPE, ROUTINE_CONTROL_TYPE, SESSION_TYPE, KWP2000Client
+from metrics import Metrics
+from patch_db import apply, load
+from simulator import SimulatedECU, SimulatedPanda
+from tp20 import TP20Transport
+
+compute_key = importlib.import_module("03_flasher").compute_key
+
+
+class Phases:
+    def __init__(self):
+        self.elapsed: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed[name] = self.elapsed.get(name, 0.0) + time.perf_counter() - start
+
+
+# Latency buckets growing by 10% from 0.1 ms to 10 s, so the percentiles
+# estimated from the histograms are within 10% of the actual values
+BENCH_BUCKETS = tuple(0.0001 * 1.1**i for i in range(121))
+
+
+def service_stats(metrics: Metrics) -> dict:
+    """Latency of every KWP service"""
+    services = {}
+    for (name, label), histogram in metrics.histograms.items():
+        if name == "kwp_request_duration_seconds" and label is not None:
+            services[label[1]] = {
+                "count": histogram.count,
+                "mean": histogram.sum / histogram.count,
+                "p50": histogram.quantile(0.5),
+                "p99": histogram.quantile(0.99),
+                "max": histogram.max,
+            }
+    return services
+
+
+def transport_stats(metrics: Metrics) -> dict:
+    """Time spent pacing frames and waiting for acks, and the number of keepalives"""
+    counters = metrics.result()["counters"]
+    ack_wait = metrics.histograms.get(("tp20_ack_wait_seconds", None))
+    return {
+        "pacing_sleep": counters.get("tp20_send_sleep_seconds_total", 0.0),
+        "ack_wait": ack_wait.sum if ack_wait is not None else 0.0,
+        "keepalives": int(counters.get("tp20_keepalives_total", 0)),
+    }
+
+
+class SimulatedCcpClient:
+    """Reads the simulated ECU's flash. Only models the round trip
+    time of every CCP command, not the CAN frames."""
+
+    def __init__(self, ecu: SimulatedECU, latency: float):
+        self.ecu = ecu
+        self.latency = latency
+        self.mta = 0
+
+    def set_memory_transfer_address(self, mta_num, addr_ext, addr):
+        time.sleep(self.latency)
+        self.mta = addr
+
+    def upload(self, size):
+        time.sleep(self.latency)
+        dat = bytes(self.ecu.flash[self.mta : self.mta + size])
+        self.mta += size
+        return dat + b"\x00" * (5 - len(dat))
+
+
+def make_image(version: str) -> bytearray:
+    """Random image with the original values of a supported version"""
+    definition = load()[version]
+    fw = bytearray(os.urandom(0x60000))
+    for addr, orig, _ in definition.patches:
+        fw[addr : addr + len(orig)] = orig
+    update_checksums(fw, definition.checksums)
+    return fw
+
+
+def bench_dump(args) -> dict:
+    ecu = SimulatedECU(flash=make_image("2501"))
+    client = SimulatedCcpClient(ecu, args.ccp_latency)
+
+    start_address = 0x5E000
+    end_address = start_address + args.dump_size - 1
+
+    start = time.perf_counter()
+    dump(client, io.BytesIO(), start_address, end_address)
+    elapsed = time.perf_counter() - start
+
+    return {"bytes": args.dump_size, "seconds": elapsed, "throughput": args.dump_size / elapsed}
+
+
+def bench_patch(args) -> dict:
+    images = [make_image("2501"), make_image("3501")]
+    db = load()
+
+    start = time.perf_counter()
+    for i in range(args.patch_images):
+        image = FirmwareImage(bytearray(images[i % len(images)]))
+        definition = db.detect(image.dat)
+        assert definition is not None
+        apply(image, definition)
+    elapsed = time.perf_counter() - start
+
+    total = args.patch_images * len(images[0])
+    return {"images": args.patch_images, "seconds": elapsed, "images_per_second": args.patch_images / elapsed, "throughput": total / elapsed}
+
+
+def bench_flash(args) -> dict:
+    ecu = SimulatedECU(flash=make_image("2501"), t3=args.t3, erase_time=args.erase_time, reboot_time=args.reboot_time, key_function=compute_key)
+    panda = SimulatedPanda(ecu, latency=args.latency, loss=args.loss, bus_load=args.bus_load)
+    phases = Phases()
+    metrics = Metrics(BENCH_BUCKETS)
+
+    start_address = 0x5E000
+    end_address = start_address + args.flash_size - 1
+    to_flash = os.urandom(args.flash_size)
+
+    start = time.perf_counter()
+    with phases.phase("channel_open"):
+        tp20 = TP20Transport(panda, 0x9, metrics=metrics)
+        kwp_client = KWP2000Client(tp20, metrics=metrics)
+
+    with phases.phase("programming_session"):
+        kwp_client.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+
+    with phases.phase("reconnect"):
+        tp20.reconnect()
+
+    with phases.phase("identification"):
+        kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH)
+
+    with phases.phase("security_access"):
+        seed = kwp_client.security_access(ACCESS_TYPE.PROGRAMMING_REQUEST_SEED)
+        key = compute_key(int.from_bytes(seed, "big")).to_bytes(4, "big")
+        kwp_client.security_access(ACCESS_TYPE.PROGRAMMING_SEND_KEY, key)
+
+    with phases.phase("request_download"):
+        block_size = max_block_size(kwp_client.request_download(start_address, args.flash_size))
+
+    with phases.phase("erase"):
+        kwp_client.erase_flash(start_address, end_address)
+        result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH)
+        assert result == b"\x00", "Erase failed"
+
+    with phases.phase("transfer"):
+        transfer(kwp_client, to_flash, block_size)
+        kwp_client.request_transfer_exit()
+
+    with phases.phase("checksum"):
+        kwp_client.calculate_flash_checksum(start_address, end_address, sum16(to_flash))
+        result = kwp_client.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM)
+        assert result == b"\x00", "Checksum check failed"
+
+    kwp_client.stop_communication()
+    elapsed = time.perf_counter() - start
+    tp20.close()
+
+    assert ecu.flash[start_address : end_address + 1] == to_flash
+
+    return {
+        "bytes": args.flash_size,
+        "seconds": elapsed,
+        "throughput": args.flash_size / elapsed,
+        "transfer_throughput": args.flash_size / phases.elapsed["transfer"],
+        "frames_sent": panda.frames_sent,
+        "frames_received": panda.frames_received,
+        "frames_lost": panda.frames_lost,
+        "phases": phases.elapsed,
+        "services": service_stats(metrics),
+        "transport": transport_stats(metrics),
+        "counters": metrics.result()["counters"],
+    }
+
+
+FLOWS = {
+    "dump": bench_dump,
+    "patch": bench_patch,
+    "flash": bench_flash,
+}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--flows", default="dump,patch,flash", help="comma separated flows to run")
+    parser.add_argument("--output", help="write results as JSON to this file instead of stdout")
+    parser.add_argument("--dump-size", default=0x1000, type=int, help="bytes to dump")
+    parser.add_argument("--ccp-latency", default=0.0025, type=float, help="round trip time of a CCP command")
+    parser.add_argument("--patch-images", default=100, type=int, help="images to patch")
+    parser.add_argument("--flash-size", default=0x1000, type=int, help="bytes to flash")
+    parser.add_argument("--latency", default=0.001, type=float, help="ECU response latency")
+    parser.add_argument("--loss", default=0.0, type=float, help="probability an ECU data frame is lost")
+    parser.add_argument("--bus-load", default=0.0, type=float, help="fraction of the bus used by other traffic")
+    parser.add_argument("--t3", default=0.01, type=float, help="interval between frames the ECU asks for")
+    parser.add_argument("--erase-time", default=0.5, type=float, help="time the ECU takes to erase")
+    parser.add_argument("--reboot-time", default=0.15, type=float, help="time the ECU takes to enter programming mode")
+    args = parser.parse_args()
+
+    parameters = {k: v for k, v in vars(args).items() if k not in ("flows", "output")}
+    results = {"parameters": parameters, "flows": {}}
+    for flow in args.flows.split(","):
+        print(f"Running {flow}...", file=sys.stderr)
+        results["flows"][flow] = FLOWS[flow](args)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
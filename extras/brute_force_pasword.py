@@ -55,7 +55,3 @@ if __name__ == "__main__":
             kwp_client.diagnostic_session_control(SESSION_TYPE.DIAGNOSTIC)
         except NegativeResponseError:
             pass
-
-        # Keep channel alive
-        tp20.can_send(b"\xa3")
-        tp20.can_recv()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import threading
+from argparse import ArgumentParser
+
+from panda import Panda  # type: ignore
+from tp20 import BusDispatcher
+from kwp2000 import KWP2000Client, ECU_IDENTIFICATION_TYPE
+
+
+def read_identification(dispatcher, module):
+    try:
+        with dispatcher.open_channel(module) as tp20:
+            kwp_client = KWP2000Client(tp20)
+            ident = kwp_client.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+            print(f"Module {hex(module)}: {ident}")
+    except Exception as e:
+        print(f"Module {hex(module)}: {e}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--bus", default=0, type=int, help="CAN bus number to use")
+    parser.add_argument("modules", nargs="+", type=lambda x: int(x, 0), help="logical module addresses (e.g. 0x1 0x9)")
+    args = parser.parse_args()
+
+    p = Panda()
+    p.can_clear(0xFFFF)
+    p.set_safety_mode(Panda.SAFETY_ALLOUTPUT)
+
+    # All channels share one dispatcher, and are serviced in parallel
+    with BusDispatcher(p, bus=args.bus) as dispatcher:
+        threads = [threading.Thread(target=read_identification, args=(dispatcher, module)) for module in args.modules]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
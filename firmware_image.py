@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Firmware image that is patched in place
+"""
+
+import mmap
+from typing import List, Tuple
+
+from checksum import ChecksumConfig, update_changed_checksums, verify_checksums
+
+# mmap access used by FirmwareImage.open for every mode
+ACCESS_MODES = {
+    "r": mmap.ACCESS_READ,  # read only
+    "r+": mmap.ACCESS_WRITE,  # changes are written to the file
+    "c": mmap.ACCESS_COPY,  # changes are only made in memory
+}
+
+
+class FirmwareImage:
+    def __init__(self, dat):
+        """Wraps a bytearray or mmap. Patches are written in place and
+        logged so they can be undone. Checksums are updated incrementally
+        from the changes since they were last updated."""
+        self.dat = dat
+        self.undo_log: List[Tuple[int, bytes]] = []
+        self.dirty: List[Tuple[int, bytes, bytes]] = []  # (addr, old, new)
+
+    @classmethod
+    def open(cls, path: str, mode: str = "r") -> "FirmwareImage":
+        """Memory map a file. In copy mode ("c") only the pages that
+        are patched are copied, the file itself is not changed."""
+        file_mode = "r+b" if mode == "r+" else "rb"
+        with open(path, file_mode) as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=ACCESS_MODES[mode]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """All views have to be released before the image can be closed"""
+        if isinstance(self.dat, mmap.mmap):
+            self.dat.close()
+
+    def __len__(self) -> int:
+        return len(self.dat)
+
+    def __getitem__(self, key) -> bytes:
+        return bytes(self.dat[key])
+
+    def view(self, start: int, end: int) -> memoryview:
+        """View of start up to and including end, without copying"""
+        return memoryview(self.dat)[start : end + 1]
+
+    def patch(self, addr: int, new: bytes):
+        assert addr + len(new) <= len(self.dat), "Patch outside of image"
+
+        old = bytes(self.dat[addr : addr + len(new)])
+        self.undo_log.append((addr, old))
+        self.dat[addr : addr + len(new)] = new
+        self.dirty.append((addr, old, bytes(new)))
+
+    def undo(self) -> int:
+        """Revert the last patch, returns its address"""
+        addr, old = self.undo_log.pop()
+        new = bytes(self.dat[addr : addr + len(old)])
+        self.dat[addr : addr + len(old)] = old
+        self.dirty.append((addr, new, old))
+        return addr
+
+    def verify_checksums(self, config: ChecksumConfig) -> bool:
+        return verify_checksums(self.dat, config)
+
+    def update_checksums(self, config: ChecksumConfig) -> ChecksumConfig:
+        """Update the checksums of the regions that contain a patched byte,
+        only the patched bytes are processed. The checksums have to be
+        valid before the first patch. Returns the regions that were updated."""
+        updated = update_changed_checksums(self.dat, self.dirty, config)
+        self.dirty = []
+        return updated
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.dat)
+
+    def flush(self):
+        if isinstance(self.dat, mmap.mmap):
+            self.dat.flush()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Find the flash sectors that differ between two firmware images
+"""
+
+from typing import List, Tuple
+
+# Smallest unit the bootloader erases. The calibration areas
+# (0x5C000, 0x5D000, 0x5E000) are each one sector.
+SECTOR_SIZE = 0x1000
+
+
+def changed_ranges(old: bytes, new: bytes, start_address: int, end_address: int, sector_size: int = SECTOR_SIZE) -> List[Tuple[int, int]]:
+    """Returns (start, end) of the sectors between start_address and
+    end_address (inclusive) that differ between old and new. Adjacent
+    sectors are merged so they can be written using a single download."""
+    assert len(old) == len(new), "Images have a different size"
+    assert start_address % sector_size == 0, "Start address is not aligned to a sector"
+    assert (end_address + 1) % sector_size == 0, "End address is not aligned to a sector"
+
+    old_view, new_view = memoryview(old), memoryview(new)
+
+    ranges: List[Tuple[int, int]] = []
+    for start in range(start_address, end_address + 1, sector_size):
+        end = start + sector_size - 1
+        if old_view[start : end + 1] == new_view[start : end + 1]:
+            continue
+
+        if ranges and ranges[-1][1] + 1 == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    return ranges
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Transfer data to the ECU in blocks as large as it accepts
+"""
+
+from kwp2000 import KWP2000Client, NegativeResponseError
+from tp20 import MAX_MESSAGE_SIZE
+
+# Responses to a TransferData with a block the ECU can't handle
+BYTE_COUNT_ERRORS = (0x75, 0x79)
+
+# Smallest block size to fall back to before giving up
+MIN_BLOCK_SIZE = 16
+
+
+def max_block_size(max_block_length: int) -> int:
+    """Number of data bytes per TransferData, given the maximum block length
+    from the RequestDownload response. The block length includes the service
+    id, and the whole request has to fit in a single TP 2.0 message."""
+    return min(max_block_length, MAX_MESSAGE_SIZE) - 1
+
+
+def transfer(kwp_client: KWP2000Client, dat: bytes, block_size: int, progress=None) -> int:
+    """Send dat using TransferData requests of block_size bytes. When the ECU
+    rejects the byte count of a block, the block size is halved and the same
+    data is sent again. Returns the block size that was used last."""
+    view = memoryview(dat)
+
+    offset = 0
+    while offset < len(view):
+        block = view[offset : offset + block_size]
+
+        try:
+            kwp_client.transfer_data(block)
+        except NegativeResponseError as e:
+            if e.error_code not in BYTE_COUNT_ERRORS or block_size // 2 < MIN_BLOCK_SIZE:
+                raise
+
+            block_size //= 2
+            continue
+
+        offset += len(block)
+        if progress is not None:
+            progress.update(len(block))
+
+    return block_size
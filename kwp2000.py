@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
+import time
 import struct
+import asyncio
 from enum import IntEnum
+from typing import Optional
 
 from panda import Panda  # type: ignore
-from tp20 import TP20Transport
+from metrics import Metrics
+from tp20 import TP20Transport, AsyncTP20Transport
 
 
 class NegativeResponseError(Exception):
@@ -92,6 +96,21 @@ class ENCRYPTION_TYPE(IntEnum):
     UNENCRYPTED = 0x0
 
 
+# Negative response codes that are handled by the client
+RESPONSE_PENDING = 0x78
+BUSY_REPEAT_REQUEST = 0x21
+
+# Timeout (P2*) for the response after the ECU replied with responsePending
+RESPONSE_PENDING_TIMEOUT = 5.0
+
+# Total time the ECU may keep replying with responsePending
+RESPONSE_PENDING_MAX_TIME = 60.0
+
+# Number of times a request is repeated after busy-RepeatRequest,
+# the delay before repeating doubles after each attempt
+BUSY_REPEAT_RETRIES = 5
+BUSY_REPEAT_DELAY = 0.05
+
 _negative_response_codes = {
     0x10: "generalReject",
     0x11: "serviceNotSupported",
@@ -123,75 +142,166 @@ _negative_response_codes = {
 }
 
 
-class KWP2000Client:
-    def __init__(self, transport: TP20Transport, debug: bool = False):
-        self.transport = transport
-        self.debug = debug
+def _encode_request(service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
+    req = bytes([service_type])
 
-    def _kwp(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
-        req = bytes([service_type])
+    if subfunction is not None:
+        req += bytes([subfunction])
+    if data is not None:
+        req += data
+
+    return req
+
+
+def _negative_response_code(resp: bytes) -> Optional[int]:
+    if len(resp) > 2 and resp[0] == 0x7F:
+        return resp[2]
+    return None
+
+
+def _count_response(metrics: Optional[Metrics], resp: bytes):
+    if metrics is not None:
+        code = _negative_response_code(resp)
+        if code is not None:
+            metrics.inc("kwp_negative_responses_total", label=("code", hex(code)))
+
+
+def _decode_response(service_type: SERVICE_TYPE, subfunction: Optional[int], resp: bytes) -> bytes:
+    resp_sid = resp[0] if len(resp) > 0 else None
+
+    # negative response
+    if resp_sid == 0x7F:
+        service_id = resp[1] if len(resp) > 1 else -1
+
+        try:
+            service_desc = SERVICE_TYPE(service_id).name
+        except BaseException:
+            service_desc = "NON_STANDARD_SERVICE"
+
+        error_code = resp[2] if len(resp) > 2 else -1
+
+        try:
+            error_desc = _negative_response_codes[error_code]
+        except BaseException:
+            error_desc = resp[3:].hex()
 
-        if subfunction is not None:
-            req += bytes([subfunction])
-        if data is not None:
-            req += data
+        raise NegativeResponseError("{} - {}".format(service_desc, error_desc), service_id, error_code)
 
-        if self.debug:
-            print(f"KWP TX: {req.hex()}")
+    # positive response
+    if service_type + 0x40 != resp_sid:
+        resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
+        raise InvalidServiceIdError("invalid response service id: {}".format(resp_sid_hex))
 
-        self.transport.send(req)
-        resp = self.transport.recv()
+    # check subfunction
+    if subfunction is not None:
+        resp_sfn = resp[1] if len(resp) > 1 else None
 
-        if self.debug:
-            print(f"KWP RX: {resp.hex()}")
+        if subfunction != resp_sfn:
+            resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
+            raise InvalidSubFunctionError(f"invalid response subfunction: {resp_sfn_hex:x}")
+
+    # return data (exclude service id and sub-function id)
+    return resp[(1 if subfunction is None else 2) :]
+
+
+def _check_security_key(access_type: ACCESS_TYPE, security_key: bytes):
+    request_seed = access_type % 2 != 0
+
+    if request_seed and len(security_key) != 0:
+        raise ValueError("security_key not allowed")
+    if not request_seed and len(security_key) == 0:
+        raise ValueError("security_key is missing")
+
+
+def _download_request(memory_address: int, uncompressed_size: int, compression_type: COMPRESSION_TYPE, encryption_type: ENCRYPTION_TYPE) -> bytes:
+    if memory_address > 0xFFFFFF:
+        raise ValueError(f"invalid memory_address {memory_address}")
+    if uncompressed_size > 0xFFFFFF:
+        raise ValueError(f"invalid uncompressed_size {uncompressed_size}")
+
+    addr = struct.pack(">L", memory_address)[1:]
+    size = struct.pack(">L", uncompressed_size)[1:]
+    return addr + bytes([(compression_type << 4) | encryption_type]) + size
+
+
+def _parse_download_response(ret: bytes) -> int:
+    if len(ret) == 1:
+        return struct.unpack(">B", ret)[0]
+    elif len(ret) == 2:
+        return struct.unpack(">H", ret)[0]
+    else:
+        raise ValueError(f"Invalid response {ret.hex()}")
+
+
+def _address_range(start_address: int, end_address: int) -> bytes:
+    if start_address > 0xFFFFFF:
+        raise ValueError(f"invalid start_address {start_address}")
+    if end_address > 0xFFFFFF:
+        raise ValueError(f"invalid end_address {end_address}")
+
+    start = struct.pack(">L", start_address)[1:]
+    end = struct.pack(">L", end_address)[1:]
+    return start + end
+
+
+def _checksum_request(start_address: int, end_address: int, checksum: int) -> bytes:
+    addr = _address_range(start_address, end_address)
+    if checksum > 0xFFFF:
+        raise ValueError(f"invalid checksum {checksum}")
+
+    return addr + struct.pack(">H", checksum)
+
+
+class KWP2000Client:
+    def __init__(self, transport: TP20Transport, debug: bool = False, metrics: Optional[Metrics] = None):
+        """The latency of every service and negative responses
+        are counted when metrics is passed"""
+        self.transport = transport
+        self.debug = debug
+        self.metrics = metrics
 
-        resp_sid = resp[0] if len(resp) > 0 else None
+    def _kwp(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
+        req = _encode_request(service_type, subfunction, data)
+        start = time.monotonic()
 
-        # negative response
-        if resp_sid == 0x7F:
-            service_id = resp[1] if len(resp) > 1 else -1
+        delay = BUSY_REPEAT_DELAY
+        for attempt in range(BUSY_REPEAT_RETRIES + 1):
+            if self.debug:
+                print(f"KWP TX: {req.hex()}")
 
-            try:
-                service_desc = SERVICE_TYPE(service_id).name
-            except BaseException:
-                service_desc = "NON_STANDARD_SERVICE"
+            self.transport.send(req)
+            resp = self.transport.recv()
 
-            error_code = resp[2] if len(resp) > 2 else -1
+            if self.debug:
+                print(f"KWP RX: {resp.hex()}")
+            _count_response(self.metrics, resp)
 
-            try:
-                error_desc = _negative_response_codes[error_code]
-            except BaseException:
-                error_desc = resp[3:].hex()
+            # Request was received, but the ECU needs more time to respond. Once the
+            # deadline passed, the responsePending is raised as a negative response.
+            deadline = time.monotonic() + RESPONSE_PENDING_MAX_TIME
+            while _negative_response_code(resp) == RESPONSE_PENDING and time.monotonic() < deadline:
+                resp = self.transport.recv(timeout=min(RESPONSE_PENDING_TIMEOUT, deadline - time.monotonic()))
 
-            raise NegativeResponseError("{} - {}".format(service_desc, error_desc), service_id, error_code)
+                if self.debug:
+                    print(f"KWP RX: {resp.hex()}")
+                _count_response(self.metrics, resp)
 
-        # positive response
-        if service_type + 0x40 != resp_sid:
-            resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
-            raise InvalidServiceIdError("invalid response service id: {}".format(resp_sid_hex))
+            if _negative_response_code(resp) != BUSY_REPEAT_REQUEST or attempt == BUSY_REPEAT_RETRIES:
+                break
 
-        # check subfunction
-        if subfunction is not None:
-            resp_sfn = resp[1] if len(resp) > 1 else None
+            time.sleep(delay)
+            delay *= 2
 
-            if subfunction != resp_sfn:
-                resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
-                raise InvalidSubFunctionError(f"invalid response subfunction: {resp_sfn_hex:x}")
+        if self.metrics is not None:
+            self.metrics.observe("kwp_request_duration_seconds", time.monotonic() - start, label=("service", service_type.name))
 
-        # return data (exclude service id and sub-function id)
-        return resp[(1 if subfunction is None else 2) :]
+        return _decode_response(service_type, subfunction, resp)
 
     def diagnostic_session_control(self, session_type: SESSION_TYPE):
         self._kwp(SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, subfunction=session_type)
 
     def security_access(self, access_type: ACCESS_TYPE, security_key: bytes = b""):
-        request_seed = access_type % 2 != 0
-
-        if request_seed and len(security_key) != 0:
-            raise ValueError("security_key not allowed")
-        if not request_seed and len(security_key) == 0:
-            raise ValueError("security_key is missing")
-
+        _check_security_key(access_type, security_key)
         return self._kwp(SERVICE_TYPE.SECURITY_ACCESS, subfunction=access_type, data=security_key)
 
     def read_ecu_identifcation(self, data_identifier_type: ECU_IDENTIFICATION_TYPE):
@@ -204,21 +314,9 @@ class KWP2000Client:
         compression_type: COMPRESSION_TYPE = COMPRESSION_TYPE.UNCOMPRESSED,
         encryption_type: ENCRYPTION_TYPE = ENCRYPTION_TYPE.UNENCRYPTED,
     ):
-        if memory_address > 0xFFFFFF:
-            raise ValueError(f"invalid memory_address {memory_address}")
-        if uncompressed_size > 0xFFFFFF:
-            raise ValueError(f"invalid uncompressed_size {uncompressed_size}")
-
-        addr = struct.pack(">L", memory_address)[1:]
-        size = struct.pack(">L", uncompressed_size)[1:]
-        data = addr + bytes([(compression_type << 4) | encryption_type]) + size
+        data = _download_request(memory_address, uncompressed_size, compression_type, encryption_type)
         ret = self._kwp(SERVICE_TYPE.REQUEST_DOWNLOAD, subfunction=None, data=data)
-        if len(ret) == 1:
-            return struct.unpack(">B", ret)[0]
-        elif len(ret) == 2:
-            return struct.unpack(">H", ret)[0]
-        else:
-            raise ValueError(f"Invalid response {ret.hex()}")
+        return _parse_download_response(ret)
 
     def start_routine_by_local_identifier(self, routine_control: ROUTINE_CONTROL_TYPE, data: bytes) -> bytes:
         return self._kwp(SERVICE_TYPE.START_ROUTINE_BY_LOCAL_IDENTIFIER, routine_control, data)
@@ -227,27 +325,12 @@ class KWP2000Client:
         return self._kwp(SERVICE_TYPE.REQUEST_ROUTINE_RESULTS_BY_LOCAL_IDENTIFIER, routine_control)
 
     def erase_flash(self, start_address: int, end_address: int) -> bytes:
-        if start_address > 0xFFFFFF:
-            raise ValueError(f"invalid start_address {start_address}")
-        if end_address > 0xFFFFFF:
-            raise ValueError(f"invalid end_address {end_address}")
-
-        start = struct.pack(">L", start_address)[1:]
-        end = struct.pack(">L", end_address)[1:]
-        return self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH, start + end)
+        data = _address_range(start_address, end_address)
+        return self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH, data)
 
     def calculate_flash_checksum(self, start_address: int, end_address: int, checksum: int) -> bytes:
-        if start_address > 0xFFFFFF:
-            raise ValueError(f"invalid start_address {start_address}")
-        if end_address > 0xFFFFFF:
-            raise ValueError(f"invalid end_address {end_address}")
-        if checksum > 0xFFFF:
-            raise ValueError(f"invalid checksum {checksum}")
-
-        start = struct.pack(">L", start_address)[1:]
-        end = struct.pack(">L", end_address)[1:]
-        chk = struct.pack(">H", checksum)
-        return self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM, start + end + chk)
+        data = _checksum_request(start_address, end_address, checksum)
+        return self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM, data)
 
     def transfer_data(self, data: bytes) -> bytes:
         return self._kwp(SERVICE_TYPE.TRANSFER_DATA, data=data)
@@ -259,6 +342,95 @@ class KWP2000Client:
         return self._kwp(SERVICE_TYPE.STOP_COMMUNICATION)
 
 
+class AsyncKWP2000Client:
+    def __init__(self, transport: AsyncTP20Transport, debug: bool = False, metrics: Optional[Metrics] = None):
+        """asyncio version of KWP2000Client, every service is a coroutine"""
+        self.transport = transport
+        self.debug = debug
+        self.metrics = metrics
+
+    async def _kwp(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
+        req = _encode_request(service_type, subfunction, data)
+        start = time.monotonic()
+
+        delay = BUSY_REPEAT_DELAY
+        for attempt in range(BUSY_REPEAT_RETRIES + 1):
+            if self.debug:
+                print(f"KWP TX: {req.hex()}")
+
+            await self.transport.send(req)
+            resp = await self.transport.recv()
+
+            if self.debug:
+                print(f"KWP RX: {resp.hex()}")
+            _count_response(self.metrics, resp)
+
+            # Request was received, but the ECU needs more time to respond. Once the
+            # deadline passed, the responsePending is raised as a negative response.
+            deadline = time.monotonic() + RESPONSE_PENDING_MAX_TIME
+            while _negative_response_code(resp) == RESPONSE_PENDING and time.monotonic() < deadline:
+                resp = await self.transport.recv(timeout=min(RESPONSE_PENDING_TIMEOUT, deadline - time.monotonic()))
+
+                if self.debug:
+                    print(f"KWP RX: {resp.hex()}")
+                _count_response(self.metrics, resp)
+
+            if _negative_response_code(resp) != BUSY_REPEAT_REQUEST or attempt == BUSY_REPEAT_RETRIES:
+                break
+
+            await asyncio.sleep(delay)
+            delay *= 2
+
+        if self.metrics is not None:
+            self.metrics.observe("kwp_request_duration_seconds", time.monotonic() - start, label=("service", service_type.name))
+
+        return _decode_response(service_type, subfunction, resp)
+
+    async def diagnostic_session_control(self, session_type: SESSION_TYPE):
+        await self._kwp(SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, subfunction=session_type)
+
+    async def security_access(self, access_type: ACCESS_TYPE, security_key: bytes = b""):
+        _check_security_key(access_type, security_key)
+        return await self._kwp(SERVICE_TYPE.SECURITY_ACCESS, subfunction=access_type, data=security_key)
+
+    async def read_ecu_identifcation(self, data_identifier_type: ECU_IDENTIFICATION_TYPE):
+        return await self._kwp(SERVICE_TYPE.READ_ECU_IDENTIFICATION, data_identifier_type)
+
+    async def request_download(
+        self,
+        memory_address: int,
+        uncompressed_size: int,
+        compression_type: COMPRESSION_TYPE = COMPRESSION_TYPE.UNCOMPRESSED,
+        encryption_type: ENCRYPTION_TYPE = ENCRYPTION_TYPE.UNENCRYPTED,
+    ):
+        data = _download_request(memory_address, uncompressed_size, compression_type, encryption_type)
+        ret = await self._kwp(SERVICE_TYPE.REQUEST_DOWNLOAD, subfunction=None, data=data)
+        return _parse_download_response(ret)
+
+    async def start_routine_by_local_identifier(self, routine_control: ROUTINE_CONTROL_TYPE, data: bytes) -> bytes:
+        return await self._kwp(SERVICE_TYPE.START_ROUTINE_BY_LOCAL_IDENTIFIER, routine_control, data)
+
+    async def request_routine_results_by_local_identifier(self, routine_control: ROUTINE_CONTROL_TYPE) -> bytes:
+        return await self._kwp(SERVICE_TYPE.REQUEST_ROUTINE_RESULTS_BY_LOCAL_IDENTIFIER, routine_control)
+
+    async def erase_flash(self, start_address: int, end_address: int) -> bytes:
+        data = _address_range(start_address, end_address)
+        return await self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH, data)
+
+    async def calculate_flash_checksum(self, start_address: int, end_address: int, checksum: int) -> bytes:
+        data = _checksum_request(start_address, end_address, checksum)
+        return await self.start_routine_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM, data)
+
+    async def transfer_data(self, data: bytes) -> bytes:
+        return await self._kwp(SERVICE_TYPE.TRANSFER_DATA, data=data)
+
+    async def request_transfer_exit(self) -> bytes:
+        return await self._kwp(SERVICE_TYPE.REQUEST_TRANSFER_EXIT)
+
+    async def stop_communication(self) -> bytes:
+        return await self._kwp(SERVICE_TYPE.STOP_COMMUNICATION)
+
+
 if __name__ == "__main__":
     p = Panda()
     p.can_clear(0xFFFF)
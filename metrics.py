@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Counters and latency histograms of the transport and the KWP client
+"""
+
+import json
+import bisect
+import threading
+from collections import defaultdict
+from typing import DefaultDict, Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Optional label of a metric, e.g. ("service", "TRANSFER_DATA")
+Label = Optional[Tuple[str, str]]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate of the q-quantile, interpolated linearly within
+        its bucket like Prometheus' histogram_quantile"""
+        rank = q * self.count
+        total = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, self.counts):
+            if count and total + count >= rank:
+                return min(lower + (upper - lower) * (rank - total) / count, self.max)
+            total += count
+            lower = upper
+        return self.max
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """(upper bound, number of values <= upper bound) of every bucket"""
+        result = []
+        total = 0
+        for le, count in zip([str(b) for b in self.buckets] + ["+Inf"], self.counts):
+            total += count
+            result.append((le, total))
+        return result
+
+    def result(self) -> dict:
+        return {"count": self.count, "sum": self.sum, "buckets": dict(self.cumulative())}
+
+
+class Metrics:
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        """Pass to TP20Transport and KWP2000Client to collect metrics.
+        Both check for None before recording anything, so there is
+        no cost when they're created without metrics."""
+        self.buckets = buckets
+        self.counters: DefaultDict[Tuple[str, Label], float] = defaultdict(float)
+        self.histograms: Dict[Tuple[str, Label], Histogram] = {}
+
+        # Frames are also sent and received from the dispatcher and keepalive threads
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, label: Label = None):
+        with self.lock:
+            self.counters[name, label] += value
+
+    def observe(self, name: str, value: float, label: Label = None):
+        with self.lock:
+            histogram = self.histograms.get((name, label))
+            if histogram is None:
+                histogram = self.histograms[name, label] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def result(self) -> dict:
+        """Metrics without a label map to their value, metrics with
+        a label map to a dict with the value for every label value"""
+        counters: Dict[str, dict] = {}
+        histograms: Dict[str, dict] = {}
+        with self.lock:
+            for (name, label), value in sorted(self.counters.items(), key=_sort_key):
+                if label is None:
+                    counters[name] = value  # type: ignore
+                else:
+                    counters.setdefault(name, {})[label[1]] = value
+
+            for (name, label), histogram in sorted(self.histograms.items(), key=_sort_key):
+                if label is None:
+                    histograms[name] = histogram.result()
+                else:
+                    histograms.setdefault(name, {})[label[1]] = histogram.result()
+
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            previous = None
+            for (name, label), value in sorted(self.counters.items(), key=_sort_key):
+                if name != previous:
+                    lines.append(f"# TYPE {name} counter")
+                    previous = name
+                lines.append(f"{name}{_format_labels(label)} {value}")
+
+            for (name, label), histogram in sorted(self.histograms.items(), key=_sort_key):
+                if name != previous:
+                    lines.append(f"# TYPE {name} histogram")
+                    previous = name
+                for le, count in histogram.cumulative():
+                    lines.append(f"{name}_bucket{_format_labels(label, ('le', le))} {count}")
+                lines.append(f"{name}_sum{_format_labels(label)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(label)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, path: str):
+        """Write the metrics as Prometheus text if the path ends
+        with .prom (e.g. for the node exporter), JSON otherwise"""
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.result(), f, indent=2)
+
+
+def _sort_key(item) -> Tuple[str, str]:
+    (name, label), _ = item
+    return name, "" if label is None else label[1]
+
+
+def _format_labels(*labels: Label) -> str:
+    pairs = [f'{key}="{value}"' for key, value in (label for label in labels if label is not None)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
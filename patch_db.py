@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Patch definitions for every supported firmware version
+"""
+
+import os
+import json
+import functools
+from typing import Dict, List, Optional, Tuple
+
+from checksum import ChecksumConfig
+from firmware_image import FirmwareImage
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "patches.json")
+
+
+class PatchDefinition:
+    def __init__(self, version: str, dat: dict):
+        """Patches and checksum regions of one firmware version. The signature
+        identifies the version and is checked like a patch without new value."""
+        self.version = version
+        self.part_number = dat["part_number"]
+        self.software_version = dat["software_version"]
+
+        signature = dat["signature"]
+        self.signature = (int(signature["address"], 0), bytes.fromhex(signature["value"]))
+
+        # (addr, orig, new (optional) )
+        self.patches: List[Tuple[int, bytes, Optional[bytes]]] = [(self.signature[0], self.signature[1], None)]
+        for p in dat["patches"]:
+            new = bytes.fromhex(p["new"]) if p.get("new") is not None else None
+            self.patches.append((int(p["address"], 0), bytes.fromhex(p["orig"]), new))
+
+        # (checksum addr, start, end)
+        self.checksums: ChecksumConfig = [(int(c["address"], 0), int(c["start"], 0), int(c["end"], 0)) for c in dat["checksums"]]
+
+
+class PatchDatabase:
+    def __init__(self, entries: Dict[str, dict]):
+        """Definitions are only parsed when they are used. The index maps the
+        address and length of every signature to the versions by signature
+        value, so detecting a version is a lookup per signature address."""
+        self.entries = entries
+        self.definitions: Dict[str, PatchDefinition] = {}
+
+        self.index: Dict[Tuple[int, int], Dict[bytes, str]] = {}
+        for version, dat in entries.items():
+            addr, value = int(dat["signature"]["address"], 0), bytes.fromhex(dat["signature"]["value"])
+            self.index.setdefault((addr, len(value)), {})[value] = version
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_PATH) -> "PatchDatabase":
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def versions(self) -> List[str]:
+        return list(self.entries)
+
+    def __getitem__(self, version: str) -> PatchDefinition:
+        if version not in self.definitions:
+            self.definitions[version] = PatchDefinition(version, self.entries[version])
+        return self.definitions[version]
+
+    def detect(self, fw) -> Optional[PatchDefinition]:
+        """Returns the definition whose signature is found in fw"""
+        for (addr, length), versions in self.index.items():
+            version = versions.get(bytes(fw[addr : addr + length]))
+            if version is not None:
+                return self[version]
+
+        return None
+
+
+def apply(image: FirmwareImage, definition: PatchDefinition):
+    """Check the signature and original values, patch the image
+    in place and update the checksums of the patched regions"""
+    assert image.verify_checksums(definition.checksums), "Invalid checksum in input FW"
+
+    for addr, orig, new in definition.patches:
+        length = len(orig)
+        cur = image[addr : addr + length]
+
+        assert cur == orig, f"Unexpected values in input FW {cur.hex()} expected {orig.hex()}"
+
+        if new is not None:
+            assert len(new) == length
+            image.patch(addr, new)
+            assert image[addr : addr + length] == new
+
+    image.update_checksums(definition.checksums)
+    assert image.verify_checksums(definition.checksums)
+
+
+@functools.lru_cache(maxsize=None)
+def load(path: str = DEFAULT_PATH) -> PatchDatabase:
+    """Loads the database once per path"""
+    return PatchDatabase.load(path)
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Simulated panda with an ECU on the bus that speaks TP 2.0 and the KWP2000
+services used by the flasher, backed by an in-memory flash. Allows running
+the whole stack without a car.
+"""
+
+import time
+import heapq
+import random
+import struct
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from tp20 import BROADCAST_ADDR, encode_timing
+from checksum import sum16
+from kwp2000 import ACCESS_TYPE, ECU_IDENTIFICATION_TYPE, ROUTINE_CONTROL_TYPE, SERVICE_TYPE, SESSION_TYPE, RESPONSE_PENDING
+
+# Time a single 8 byte frame occupies a 500 kbit/s bus
+FRAME_TIME = 0.00023
+
+# Address the ECU listens on for channel data
+ECU_TX_ADDR = 0x7A8
+
+# Frames on the simulated bus that are not part of the channel
+BACKGROUND_ADDRS = (0x1A0, 0x280, 0x288, 0x320, 0x480, 0x5A0)
+
+# Status frame the ECU broadcasts periodically while it's not rebooting
+STATUS_ADDR = 0x3D0
+STATUS_INTERVAL = 0.01
+
+# Services that are only available after unlocking the programming session
+PROGRAMMING_SERVICES = (
+    SERVICE_TYPE.REQUEST_DOWNLOAD,
+    SERVICE_TYPE.TRANSFER_DATA,
+    SERVICE_TYPE.REQUEST_TRANSFER_EXIT,
+    SERVICE_TYPE.START_ROUTINE_BY_LOCAL_IDENTIFIER,
+    SERVICE_TYPE.REQUEST_ROUTINE_RESULTS_BY_LOCAL_IDENTIFIER,
+)
+
+# (addr, dat, delay) of a frame sent by the ECU
+Frame = Tuple[int, bytes, float]
+
+
+class SimulatedECU:
+    def __init__(
+        self,
+        flash: Optional[bytes] = None,
+        module: int = 0x9,
+        ident: bytes = b"1K0909144E  2501\x00\x00\x00\x00------EPS_ZFLS Kl. 184    ",
+        max_block_length: int = 0xFF,
+        t1: float = 0.1,
+        t3: float = 0.01,
+        erase_time: float = 0.5,
+        reboot_time: float = 0.15,
+        key_function: Optional[Callable[[int], int]] = None,
+        seed: int = 0,
+    ):
+        """Reacts to the frames the tester sends, and returns the frames
+        it sends back. t1 and t3 are the timing parameters the ECU replies
+        with, the defaults are the values of the real ECU. The flash is
+        erased to 0xFF and written using RequestDownload and TransferData
+        like on the real ECU. When a key_function is given, SecurityAccess
+        checks the key against it."""
+        self.flash = bytearray(flash) if flash is not None else bytearray(b"\xff" * 0x60000)
+        self.module = module
+        self.ident = ident
+        self.max_block_length = max_block_length
+        self.t1 = t1
+        self.t3 = t3
+        self.erase_time = erase_time
+        self.reboot_time = reboot_time
+        self.key_function = key_function
+        self.rng = random.Random(seed)
+
+        self.session = int(SESSION_TYPE.DIAGNOSTIC)
+        self.seed: Optional[int] = None
+        self.unlocked = False
+
+        self.download_address: Optional[int] = None
+        self.download_end = 0
+        self.erase_done = 0.0
+        self.routine_results: Dict[int, bytes] = {ROUTINE_CONTROL_TYPE.ERASE_FLASH: b"\x01", ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM: b"\x01"}
+
+        # The ECU ignores everything until it is done rebooting
+        self.offline_until = 0.0
+
+        self.reset_channel()
+
+        # Number of requests handled per service
+        self.requests: Dict[int, int] = {}
+
+    def reset_channel(self):
+        self.rx_addr: Optional[int] = None  # Tester RX address, where we transmit
+        self.connected = False
+        self.block_size = 0x0F
+
+        # Receiving
+        self.rx_seq = 0
+        self.rx_buf = bytearray()
+
+        # Transmitting, frames of the current message and the messages after it
+        self.tx_seq = 0
+        self.tx_frames: List[Tuple[int, bytes]] = []
+        self.tx_block_start = 0
+        self.tx_sent = 0
+        self.tx_queue: List[Tuple[float, bytes]] = []
+
+    def receive(self, addr: int, dat: bytes, now: float) -> List[Frame]:
+        if now < self.offline_until:
+            return []
+
+        if addr == BROADCAST_ADDR:
+            return self.handle_setup(dat)
+        if addr == ECU_TX_ADDR and self.rx_addr is not None:
+            return self.handle_channel(dat, now)
+        return []
+
+    def handle_setup(self, dat: bytes) -> List[Frame]:
+        if len(dat) != 7 or dat[0] != self.module or dat[1] != 0xC0:
+            return []
+
+        self.reset_channel()
+        self.rx_addr = struct.unpack("<H", dat[4:6])[0]
+        return [(BROADCAST_ADDR + self.module, bytes([0x00, 0xD0]) + struct.pack("<HH", self.rx_addr, ECU_TX_ADDR) + b"\x01", 0.0)]
+
+    def parameters(self) -> bytes:
+        return bytes([0xA1, 0x0F, encode_timing(self.t1), 0xFF, encode_timing(self.t3), 0xFF])
+
+    def handle_channel(self, dat: bytes, now: float) -> List[Frame]:
+        assert self.rx_addr is not None
+        opcode = dat[0]
+
+        if opcode == 0xA0:  # Parameters request
+            self.block_size = dat[1]
+            self.connected = True
+            self.rx_seq = self.tx_seq = 0
+            return [(self.rx_addr, self.parameters(), 0.0)]
+        if opcode == 0xA3:  # Channel test
+            return [(self.rx_addr, self.parameters(), 0.0)]
+        if opcode == 0xA8:  # Disconnect
+            rx_addr = self.rx_addr
+            self.reset_channel()
+            return [(rx_addr, b"\xa8", 0.0)]
+        if opcode >> 4 == 0xB:  # ACK
+            return self.handle_ack(opcode & 0xF, now)
+        if opcode >> 4 <= 0x3:
+            return self.handle_data(dat, now)
+        return []
+
+    def handle_data(self, dat: bytes, now: float) -> List[Frame]:
+        assert self.rx_addr is not None
+        typ, seq = dat[0] >> 4, dat[0] & 0xF
+        wants_ack = typ in (0x0, 0x1)
+
+        # Drop frames out of sequence, the tester retransmits after our ack
+        if seq != self.rx_seq:
+            return [(self.rx_addr, bytes([0xB0 | self.rx_seq]), 0.0)] if wants_ack else []
+
+        self.rx_seq = (seq + 1) & 0xF
+        self.rx_buf += dat[1:]
+
+        frames = []
+        if wants_ack:
+            frames.append((self.rx_addr, bytes([0xB0 | self.rx_seq]), 0.0))
+
+        if typ in (0x1, 0x3):
+            length = struct.unpack(">H", self.rx_buf[:2])[0]
+            req = bytes(self.rx_buf[2 : 2 + length])
+            self.rx_buf = bytearray()
+
+            for delay, resp in self.handle_request(req, now):
+                self.tx_queue.append((now + delay, resp))
+
+            if not self.tx_frames:
+                frames += self.next_message(now)
+
+        return frames
+
+    def next_message(self, now: float) -> List[Frame]:
+        """Start sending the next queued response"""
+        if not self.tx_queue:
+            return []
+
+        not_before, resp = self.tx_queue.pop(0)
+        payload = struct.pack(">H", len(resp)) + resp
+
+        self.tx_frames = []
+        for offset in range(0, len(payload), 7):
+            self.tx_frames.append((self.tx_seq, payload[offset : offset + 7]))
+            self.tx_seq = (self.tx_seq + 1) & 0xF
+
+        self.tx_block_start = 0
+        self.tx_sent = 0
+        return self.send_block(self.tx_block_start, max(0.0, not_before - now))
+
+    def send_block(self, start: int, delay: float = 0.0) -> List[Frame]:
+        """Send the frames from start up to the end of the block.
+        The last frame of a block or message waits for an ack."""
+        assert self.rx_addr is not None
+        end = min(self.tx_block_start + self.block_size, len(self.tx_frames))
+
+        frames = []
+        for i in range(start, end):
+            seq, chunk = self.tx_frames[i]
+            if i == len(self.tx_frames) - 1:
+                opcode = 0x10
+            elif i == end - 1:
+                opcode = 0x00
+            else:
+                opcode = 0x20
+            frames.append((self.rx_addr, bytes([opcode | seq]) + chunk, delay))
+
+        self.tx_sent = end
+        return frames
+
+    def handle_ack(self, seq: int, now: float) -> List[Frame]:
+        if not self.tx_frames:
+            return []
+
+        # Everything up to the end of the block was received
+        if self.tx_sent > 0 and seq == (self.tx_frames[self.tx_sent - 1][0] + 1) & 0xF:
+            if self.tx_sent == len(self.tx_frames):
+                self.tx_frames = []
+                return self.next_message(now)
+
+            self.tx_block_start = self.tx_sent
+            return self.send_block(self.tx_block_start)
+
+        # Retransmit starting at the frame the tester expects
+        for i in range(self.tx_block_start, self.tx_sent):
+            if self.tx_frames[i][0] == seq:
+                return self.send_block(i)
+        return []
+
+    def handle_request(self, req: bytes, now: float) -> List[Tuple[float, bytes]]:
+        """Returns (delay, response) of every response to a KWP request"""
+        sid = req[0]
+        self.requests[sid] = self.requests.get(sid, 0) + 1
+
+        def negative(code: int) -> List[Tuple[float, bytes]]:
+            return [(0.0, bytes([0x7F, sid, code]))]
+
+        def positive(dat: bytes = b"") -> List[Tuple[float, bytes]]:
+            return [(0.0, bytes([sid + 0x40]) + dat)]
+
+        if sid == SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL:
+            if req[1] not in list(SESSION_TYPE):
+                return negative(0x12)
+
+            self.session = req[1]
+            self.unlocked = False
+            if self.session == SESSION_TYPE.PROGRAMMING:
+                # Reboot into the bootloader after responding
+                self.offline_until = now + self.reboot_time
+                self.tx_queue.clear()
+            return positive(req[1:2])
+
+        if sid == SERVICE_TYPE.READ_ECU_IDENTIFICATION:
+            if req[1] == ECU_IDENTIFICATION_TYPE.ECU_IDENT:
+                return positive(req[1:2] + self.ident)
+            if req[1] == ECU_IDENTIFICATION_TYPE.STATUS_FLASH:
+                return positive(req[1:2] + b"\x00\x1b\x0f\x00--------.--.--")
+            return negative(0x12)
+
+        if sid == SERVICE_TYPE.SECURITY_ACCESS:
+            if req[1] == ACCESS_TYPE.PROGRAMMING_REQUEST_SEED:
+                self.seed = self.rng.getrandbits(32)
+                return positive(req[1:2] + struct.pack(">I", self.seed))
+            if req[1] == ACCESS_TYPE.PROGRAMMING_SEND_KEY and self.seed is not None:
+                key = struct.unpack(">I", req[2:6])[0]
+                if self.key_function is not None and key != self.key_function(self.seed):
+                    return negative(0x35)
+                self.unlocked = True
+                return positive(req[1:2])
+            return negative(0x12)
+
+        if sid == SERVICE_TYPE.TESTER_PRESENT:
+            return positive()
+
+        if sid == SERVICE_TYPE.STOP_COMMUNICATION:
+            return positive()
+
+        # Services below require an unlocked programming session
+        if sid not in PROGRAMMING_SERVICES:
+            return negative(0x11)
+        if self.session != SESSION_TYPE.PROGRAMMING or not self.unlocked:
+            return negative(0x33)
+
+        if sid == SERVICE_TYPE.REQUEST_DOWNLOAD:
+            addr = struct.unpack(">I", b"\x00" + req[1:4])[0]
+            size = struct.unpack(">I", b"\x00" + req[5:8])[0]
+            if addr + size > len(self.flash):
+                return negative(0x42)
+            self.download_address, self.download_end = addr, addr + size
+            return positive(bytes([self.max_block_length]))
+
+        if sid == SERVICE_TYPE.TRANSFER_DATA:
+            if self.download_address is None:
+                return negative(0x22)
+            dat = req[1:]
+            if len(dat) > self.max_block_length - 1:
+                return negative(0x75)
+            if self.download_address + len(dat) > self.download_end:
+                return negative(0x79)
+
+            # Flash can only be programmed from 1 to 0
+            addr = self.download_address
+            self.flash[addr : addr + len(dat)] = bytes(a & b for a, b in zip(self.flash[addr : addr + len(dat)], dat))
+            self.download_address += len(dat)
+            return positive()
+
+        if sid == SERVICE_TYPE.REQUEST_TRANSFER_EXIT:
+            self.download_address = None
+            return positive()
+
+        if sid == SERVICE_TYPE.START_ROUTINE_BY_LOCAL_IDENTIFIER:
+            start = struct.unpack(">I", b"\x00" + req[2:5])[0]
+            end = struct.unpack(">I", b"\x00" + req[5:8])[0]
+            if end >= len(self.flash) or start > end:
+                return negative(0x31)
+
+            if req[1] == ROUTINE_CONTROL_TYPE.ERASE_FLASH:
+                self.flash[start : end + 1] = b"\xff" * (end + 1 - start)
+                self.erase_done = now + self.erase_time
+                self.routine_results[ROUTINE_CONTROL_TYPE.ERASE_FLASH] = b"\x00"
+                return positive(req[1:2])
+            if req[1] == ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM:
+                checksum = struct.unpack(">H", req[8:10])[0]
+                ok = sum16(self.flash[start : end + 1]) == checksum
+                self.routine_results[ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM] = b"\x00" if ok else b"\x01"
+                return positive(req[1:2])
+            return negative(0x12)
+
+        if sid == SERVICE_TYPE.REQUEST_ROUTINE_RESULTS_BY_LOCAL_IDENTIFIER:
+            result = positive(req[1:2] + self.routine_results.get(req[1], b"\x01"))
+            if req[1] == ROUTINE_CONTROL_TYPE.ERASE_FLASH and now < self.erase_done:
+                # Still erasing, the result follows once it's done
+                return negative(RESPONSE_PENDING) + [(self.erase_done - now, result[0][1])]
+            return result
+
+        return negative(0x11)
+
+
+class SimulatedPanda:
+    SAFETY_ALLOUTPUT = 17
+
+    def __init__(
+        self,
+        ecu: SimulatedECU,
+        bus: int = 0,
+        latency: float = 0.001,
+        loss: float = 0.0,
+        bus_load: float = 0.0,
+        frame_time: float = FRAME_TIME,
+        seed: int = 0,
+    ):
+        """Drop-in replacement for a panda with the ECU on the bus.
+
+        latency: time between the last frame of a request and the ECU's first
+        response frame. loss: probability a data frame sent by the ECU is
+        lost, see lose(). bus_load: fraction of the bus used
+        by other traffic. It slows down the ECU's frames, and the other frames
+        are returned from can_recv like on a real bus. The ECU's status frame
+        is returned every STATUS_INTERVAL, except while it reboots."""
+        assert 0 <= bus_load < 1
+
+        self.ecu = ecu
+        self.bus = bus
+        self.latency = latency
+        self.loss = loss
+        self.bus_load = bus_load
+        self.frame_time = frame_time / (1 - bus_load)
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.pending: List[Tuple[float, int, int, bytes]] = []
+        self.counter = 0
+        self.bus_free = 0.0
+        self.message_start = True
+        self.last_recv = time.monotonic()
+        self.next_status = 0.0
+
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.frames_lost = 0
+
+    def set_safety_mode(self, mode):
+        pass
+
+    def can_clear(self, bus):
+        pass
+
+    def can_send(self, addr, dat, bus, timeout=0):
+        if bus != self.bus:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.frames_sent += 1
+
+            # Frames go on the bus back to back once the ECU has processed the request.
+            # Delayed frames don't hold up the frames that are sent in the meantime.
+            prev = 0.0
+            for resp_addr, resp, delay in self.ecu.receive(addr, bytes(dat), now):
+                start = now + self.latency + delay
+                if delay == 0:
+                    start = max(start, self.bus_free)
+                t = prev = max(start, prev) + self.frame_time
+                if delay == 0:
+                    self.bus_free = t
+
+                if self.lose(resp_addr, resp):
+                    self.frames_lost += 1
+                    continue
+
+                heapq.heappush(self.pending, (t, self.counter, resp_addr, resp))
+                self.counter += 1
+
+    def can_send_many(self, arr, timeout=0):
+        for addr, _, dat, bus in arr:
+            self.can_send(addr, dat, bus, timeout)
+
+    def lose(self, addr: int, dat: bytes) -> bool:
+        """Only data frames after the first frame of a message are lost. The
+        transport requests a retransmission once it knows a message is
+        incomplete, but not when a message or an ack never arrives."""
+        if addr == BROADCAST_ADDR + self.ecu.module or dat[0] >> 4 > 0x3:
+            return False
+
+        first = self.message_start
+        self.message_start = dat[0] >> 4 in (0x1, 0x3)
+        return not first and self.rng.random() < self.loss
+
+    def can_recv(self):
+        with self.lock:
+            now = time.monotonic()
+
+            msgs = []
+            while self.pending and self.pending[0][0] <= now:
+                _, _, addr, dat = heapq.heappop(self.pending)
+                msgs.append((addr, 0, dat, self.bus))
+            self.frames_received += len(msgs)
+
+            if now >= self.ecu.offline_until and now >= self.next_status:
+                msgs.append((STATUS_ADDR, 0, b"\x00" * 8, self.bus))
+                self.next_status = now + STATUS_INTERVAL
+
+            if self.bus_load > 0:
+                count = int((now - self.last_recv) * self.bus_load / FRAME_TIME)
+                for _ in range(count):
+                    msgs.append((self.rng.choice(BACKGROUND_ADDRS), 0, bytes(self.rng.getrandbits(8) for _ in range(8)), self.bus))
+                if count:
+                    self.last_recv = now
+            else:
+                self.last_recv = now
+
+            return msgs
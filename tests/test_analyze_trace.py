@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import tempfile
+import unittest
+
+from can_trace import RecordingPanda, TraceRecorder
+from extras.analyze_trace import Reassembly, analyze
+from kwp2000 import ECU_IDENTIFICATION_TYPE, KWP2000Client
+from simulator import SimulatedECU, SimulatedPanda
+from tp20 import TP20Transport
+
+MESSAGE = bytes(range(0x1A))
+
+
+def frames(msg: bytes, first_seq: int = 0):
+    """Frames of a message, the last one of every block of 4 waits for an ack"""
+    payload = struct.pack(">H", len(msg)) + msg
+    chunks = [payload[i : i + 7] for i in range(0, len(payload), 7)]
+
+    result = []
+    for i, chunk in enumerate(chunks):
+        if i == len(chunks) - 1:
+            opcode = 0x10
+        elif i % 4 == 3:
+            opcode = 0x00
+        else:
+            opcode = 0x20
+        result.append(bytes([opcode | ((first_seq + i) & 0xF)]) + chunk)
+    return result
+
+
+def feed(reassembly: Reassembly, seqs, msg: bytes = MESSAGE):
+    """Feed the frames of msg in the order of seqs, returns the completed messages"""
+    by_seq = {f[0] & 0xF: f for f in frames(msg)}
+    return [m for m in (reassembly.feed(0.0, by_seq[seq]) for seq in seqs) if m is not None]
+
+
+class TestReassembly(unittest.TestCase):
+    def test_in_order(self):
+        reassembly = Reassembly()
+        self.assertEqual(feed(reassembly, [0, 1, 2, 3]), [MESSAGE])
+        self.assertEqual(reassembly.retransmissions, 0)
+        self.assertEqual(reassembly.gaps, 0)
+
+    def test_lost_frame(self):
+        # Frame 1 is lost, the receiver acks with 1 and the sender retransmits from there
+        reassembly = Reassembly()
+        self.assertEqual(feed(reassembly, [0, 2, 3, 1, 2, 3]), [MESSAGE])
+        self.assertEqual(reassembly.retransmissions, 1)
+        self.assertEqual(reassembly.gaps, 1)
+
+    def test_retransmission(self):
+        # The receiver missed frame 1, the sender goes back to it
+        reassembly = Reassembly()
+        self.assertEqual(feed(reassembly, [0, 1, 2, 1, 2, 3]), [MESSAGE])
+        self.assertEqual(reassembly.retransmissions, 1)
+        self.assertEqual(reassembly.gaps, 0)
+
+    def test_retransmission_of_last_frame(self):
+        # The ack of the last frame was lost
+        reassembly = Reassembly()
+        self.assertEqual(feed(reassembly, [0, 1, 2, 3, 3]), [MESSAGE])
+        self.assertEqual(reassembly.retransmissions, 1)
+
+    def test_lost_from_trace(self):
+        # The receiver got frame 1, the sender continues with the next message
+        reassembly = Reassembly()
+        self.assertEqual(feed(reassembly, [0, 2, 3]), [])
+
+        msg = frames(b"\x50\x85", first_seq=4)
+        self.assertEqual([reassembly.feed(0.0, f) for f in msg], [b"\x50\x85"])
+        self.assertEqual(reassembly.gaps, 1)
+
+
+class TestAnalyzeTrace(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".trace")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_frame_loss(self):
+        ecu = SimulatedECU(t3=0.0001)
+        panda = SimulatedPanda(ecu, loss=0.1, seed=1)
+
+        with TraceRecorder(self.path) as recorder:
+            with TP20Transport(RecordingPanda(panda, recorder), 0x9, keepalive=False) as tp20:
+                kwp = KWP2000Client(tp20)
+                for _ in range(10):
+                    self.assertEqual(kwp.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), ecu.ident)
+
+        result = analyze(self.path)
+        session = result["sessions"][0]
+        self.assertGreater(panda.frames_lost, 0)
+        self.assertEqual(session["requests"], 10)
+        self.assertEqual(result["services"]["READ_ECU_IDENTIFICATION"]["count"], 10)
+
+        # Every gap is filled by one retransmission from the missing frame
+        self.assertGreater(session["gaps"], 0)
+        self.assertEqual(session["retransmissions"], session["gaps"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from batch_patcher import find_inputs, output_paths, patch_file, run
+from checksum import update_checksums, verify_checksums
+from patch_db import load
+
+
+def make_image(version):
+    definition = load()[version]
+    fw = bytearray(os.urandom(0x60000))
+    for addr, orig, _ in definition.patches:
+        fw[addr : addr + len(orig)] = orig
+    update_checksums(fw, definition.checksums)
+    return fw
+
+
+class TestBatchPatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        os.mkdir(os.path.join(self.dir, "out"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, dat):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(dat)
+        return path
+
+    def test_find_inputs(self):
+        a = self.write("a.bin", b"")
+        b = self.write("b.bin", b"")
+        self.write("notes.txt", b"")
+        manifest = self.write("manifest.txt", b"# images\nb.bin\n\na.bin  # first\n")
+
+        self.assertEqual(find_inputs(self.dir), [a, b])
+        self.assertEqual(find_inputs(manifest), [b, a])
+
+    def test_output_paths(self):
+        os.mkdir(os.path.join(self.dir, "x"))
+        os.mkdir(os.path.join(self.dir, "y"))
+        x = self.write("x/fw.bin", b"")
+        y = self.write("y/fw.bin", b"")
+        out = os.path.join(self.dir, "out")
+
+        self.assertEqual(output_paths([x, y], out), [(x, os.path.join(out, "x", "fw.bin")), (y, os.path.join(out, "y", "fw.bin"))])
+        self.assertEqual(output_paths([x], out), [(x, os.path.join(out, "fw.bin"))])
+
+        with self.assertRaises(ValueError):
+            output_paths([x, x], out)
+        with self.assertRaises(ValueError):
+            output_paths([x], os.path.join(self.dir, "x"))
+
+    def test_patch_file(self):
+        fw = make_image("2501")
+        input_path = self.write("a.bin", fw)
+        output_path = os.path.join(self.dir, "out", "a.bin")
+
+        result = patch_file(input_path, output_path)
+        self.assertEqual(result["version"], "2501")
+        self.assertIsNone(result["error"])
+
+        with open(output_path, "rb") as f:
+            out = f.read()
+        definition = load()["2501"]
+        self.assertTrue(verify_checksums(out, definition.checksums))
+        self.assertEqual(out[0x5E283], 0x00)
+        self.assertEqual(out[0x5FFFC:], b"\xff" * 4)
+        self.assertEqual(out[:0x5E000], fw[:0x5E000])
+
+    def test_patch_file_invalid_checksum(self):
+        fw = make_image("3501")
+        fw[0x5C100] ^= 0xFF
+        output_path = os.path.join(self.dir, "out", "a.bin")
+
+        result = patch_file(self.write("a.bin", fw), output_path)
+        self.assertEqual(result["version"], "3501")
+        self.assertIn("checksum", result["error"])
+        self.assertFalse(os.path.exists(output_path))
+
+    def test_run(self):
+        jobs = []
+        for name, dat in [("a.bin", make_image("2501")), ("b.bin", make_image("3501")), ("c.bin", bytes(0x60000))]:
+            jobs.append((self.write(name, dat), os.path.join(self.dir, "out", name)))
+
+        results = run(jobs, workers=2)
+        self.assertEqual([r["version"] for r in results], ["2501", "3501", None])
+        self.assertEqual([r["error"] is None for r in results], [True, True, False])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, "out"))), ["a.bin", "b.bin"])
+
+
+if __name__ == "__main__":
+    unittest.main()
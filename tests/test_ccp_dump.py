@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from ccp_dump import Checkpoint, dump, verify, MAX_UPLOAD_SIZE
+
+
+class FakeCcpClient:
+    def __init__(self, memory):
+        self.memory = memory
+        self.mta = 0
+        self.corrupt = 0  # Number of uploads to return corrupted data for
+        self.fail_at = None  # Uploads from this address raise an error
+        self.set_memory_transfer_address = Mock(side_effect=self._set_mta)
+        self.upload = Mock(side_effect=self._upload)
+
+    def _set_mta(self, mta_num, addr_ext, addr):
+        self.mta = addr
+
+    def _upload(self, size):
+        if self.fail_at is not None and self.mta >= self.fail_at:
+            raise IOError("bus error")
+
+        dat = self.memory[self.mta : self.mta + size]
+        self.mta += size
+
+        if self.corrupt:
+            self.corrupt -= 1
+            dat = bytes(b ^ 0xFF for b in dat)
+        return dat + b"\x00" * (5 - len(dat))
+
+
+class TestDump(unittest.TestCase):
+    def test_dump(self):
+        memory = bytes(range(256)) * 4
+        client = FakeCcpClient(memory)
+        f = io.BytesIO()
+
+        dump(client, f, 0x10, 0x3FF, Mock())
+
+        self.assertEqual(f.getvalue(), memory[0x10:])
+        client.set_memory_transfer_address.assert_called_once_with(0, 0, 0x10)
+        self.assertEqual(max(c.args[0] for c in client.upload.call_args_list), MAX_UPLOAD_SIZE)
+        self.assertEqual(client.upload.call_count, (0x400 - 0x10 + MAX_UPLOAD_SIZE - 1) // MAX_UPLOAD_SIZE)
+
+    def test_resume(self):
+        memory = os.urandom(0x3000)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "dump.bin.ckpt")
+            f = io.BytesIO()
+
+            # Interrupt dump in the second region
+            client = FakeCcpClient(memory)
+            client.fail_at = 0x1800
+            with self.assertRaises(IOError):
+                dump(client, f, 0, 0x2FFF, checkpoint=Checkpoint(path, 0, 0x2FFF))
+
+            checkpoint = Checkpoint.load(path)
+            self.assertEqual(checkpoint.next_address, 0x1000)
+            self.assertEqual(len(checkpoint.crcs), 1)
+
+            client = FakeCcpClient(memory)
+            dump(client, f, 0, 0x2FFF, checkpoint=checkpoint)
+            self.assertEqual(f.getvalue(), memory)
+            client.set_memory_transfer_address.assert_any_call(0, 0, 0x1000)
+            self.assertEqual(Checkpoint.load(path).next_address, 0x3000)
+
+    def test_verify(self):
+        memory = os.urandom(0x3000)
+        with tempfile.TemporaryDirectory() as d:
+            checkpoint = Checkpoint(os.path.join(d, "dump.bin.ckpt"), 0, 0x2FFF)
+            f = io.BytesIO()
+
+            # First upload returns corrupted data
+            client = FakeCcpClient(memory)
+            client.corrupt = 1
+            dump(client, f, 0, 0x2FFF, checkpoint=checkpoint)
+            self.assertNotEqual(f.getvalue(), memory)
+
+            fixed = verify(client, f, checkpoint)
+            self.assertEqual(fixed, [(0, 0xFFF)])
+            self.assertEqual(f.getvalue(), memory)
+            self.assertEqual(verify(client, f, checkpoint), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import struct
+import unittest
+from unittest.mock import patch as mock_patch
+
+import checksum
+from checksum import crc16, crc_function, crc_update, patch, sum16, update_checksums, verify_checksums, XMODEM_POLY
+
+# Same layout as the 3501 calibration area, including the overlapping byte
+CONFIG = [
+    (0x1FFC, 0x0000, 0x0FFF),
+    (0x1FFE, 0x0FFF, 0x1FFC),
+    (0x2FFE, 0x2000, 0x2FFE),
+]
+
+
+class TestChecksum(unittest.TestCase):
+    def test_crc16(self):
+        self.assertEqual(crc16(b"123456789"), b"\x31\xc3")
+        self.assertEqual(crc16(memoryview(b"123456789")), b"\x31\xc3")
+
+    def test_crc_function_cached(self):
+        self.assertIs(crc_function(XMODEM_POLY), crc_function(XMODEM_POLY))
+
+    def test_sum16(self):
+        dat = bytes([0xFF]) * 0x1000
+        self.assertEqual(sum16(dat), (0xFF * 0x1000) & 0xFFFF)
+
+        with mock_patch.object(checksum, "np", None):
+            self.assertEqual(sum16(memoryview(dat)), (0xFF * 0x1000) & 0xFFFF)
+
+    def test_crc_update(self):
+        rnd = random.Random(0)
+        for _ in range(50):
+            dat = bytearray(rnd.randbytes(rnd.randint(1, 0x1000)))
+            crc = crc_function(XMODEM_POLY)(dat)
+
+            offset = rnd.randrange(len(dat))
+            new = rnd.randbytes(rnd.randint(1, len(dat) - offset))
+            old = bytes(dat[offset : offset + len(new)])
+            dat[offset : offset + len(new)] = new
+
+            self.assertEqual(crc_update(crc, len(dat), offset, old, new), crc_function(XMODEM_POLY)(dat))
+
+    def test_update_checksums(self):
+        fw = bytearray(os.urandom(0x3000))
+        self.assertFalse(verify_checksums(fw, CONFIG))
+
+        update_checksums(fw, CONFIG)
+        self.assertTrue(verify_checksums(fw, CONFIG))
+        self.assertEqual(fw[0x2FFE:0x3000], crc16(fw[0x2000:0x2FFE]))
+
+    def test_patch(self):
+        fw = bytearray(os.urandom(0x3000))
+        update_checksums(fw, CONFIG)
+
+        patch(fw, 0x0FFE, b"\x00\x00\x00", CONFIG)  # Spans the first two regions
+        patch(fw, 0x2221, b"\x00", CONFIG)
+        patch(fw, 0x2FFC, b"\xff\xff", CONFIG)  # Outside of all regions
+
+        self.assertEqual(fw[0x0FFE:0x1001], b"\x00\x00\x00")
+        self.assertTrue(verify_checksums(fw, CONFIG))
+
+        expected = bytearray(fw)
+        update_checksums(expected, CONFIG)
+        self.assertEqual(fw, expected)
+        self.assertEqual(struct.unpack(">H", fw[0x1FFC:0x1FFE])[0], crc_function(XMODEM_POLY)(fw[0:0xFFF]))
+
+    def test_patch_checksum(self):
+        fw = bytearray(0x3000)
+        with self.assertRaises(AssertionError):
+            patch(fw, 0x1FFB, b"\x00\x00", CONFIG)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch as mock_patch
+
+import checksum
+from checksum import crc16, update_checksums
+from firmware_image import FirmwareImage
+
+CONFIG = [
+    (0x1FFC, 0x0000, 0x1000),
+    (0x1FFE, 0x1000, 0x1FFC),
+]
+
+
+class TestFirmwareImage(unittest.TestCase):
+    def setUp(self):
+        self.dat = bytearray(os.urandom(0x2000))
+        update_checksums(self.dat, CONFIG)
+        self.orig = bytes(self.dat)
+        self.image = FirmwareImage(self.dat)
+
+    def test_view(self):
+        view = self.image.view(0x10, 0x1F)
+        self.assertEqual(len(view), 0x10)
+        self.assertEqual(view, self.orig[0x10:0x20])
+
+        # Zero copy, patches are visible through existing views
+        self.image.patch(0x10, b"\x00")
+        self.assertEqual(view[0], 0x00)
+
+    def test_patch_undo(self):
+        self.image.patch(0x100, b"\x01\x02")
+        self.image.patch(0x101, b"\x03")
+        self.assertEqual(self.image[0x100:0x102], b"\x01\x03")
+
+        self.assertEqual(self.image.undo(), 0x101)
+        self.assertEqual(self.image[0x100:0x102], b"\x01\x02")
+        self.image.undo()
+        self.assertEqual(bytes(self.dat), self.orig)
+
+        with self.assertRaises(IndexError):
+            self.image.undo()
+
+    def test_update_checksums(self):
+        self.assertTrue(self.image.verify_checksums(CONFIG))
+        self.image.patch(0x1100, b"\x00\x00")
+        self.assertFalse(self.image.verify_checksums(CONFIG))
+
+        # Only the patched bytes are processed, the region isn't read
+        with mock_patch.object(checksum, "crc16", wraps=checksum.crc16) as crc:
+            self.assertEqual(self.image.update_checksums(CONFIG), [CONFIG[1]])
+            crc.assert_not_called()
+
+        self.assertTrue(self.image.verify_checksums(CONFIG))
+        self.assertEqual(self.image[0x1FFE:0x2000], crc16(self.dat[0x1000:0x1FFC]))
+
+        # Nothing changed since the last update
+        self.assertEqual(self.image.update_checksums(CONFIG), [])
+
+    def test_overlapping_patches_checksums(self):
+        self.image.patch(0xFF0, b"\x01" * 0x20)
+        self.image.patch(0xFF8, b"\x02" * 0x4)
+        self.image.undo()
+        self.image.patch(0x1000, b"\x03")
+        self.assertEqual(self.image.update_checksums(CONFIG), CONFIG)
+        self.assertTrue(self.image.verify_checksums(CONFIG))
+
+    def test_undo_checksums(self):
+        self.image.patch(0x10, b"\x00" * 0x10)
+        self.image.update_checksums(CONFIG)
+        self.image.undo()
+        self.image.update_checksums(CONFIG)
+        self.assertEqual(bytes(self.dat), self.orig)
+
+    def test_open(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "fw.bin")
+            with open(path, "wb") as f:
+                f.write(self.orig)
+
+            # Copy on write doesn't change the file
+            with FirmwareImage.open(path, "c") as image:
+                image.patch(0x0, b"\x00")
+                image.update_checksums(CONFIG)
+                image.save(path + ".out")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), self.orig)
+            with open(path + ".out", "rb") as f:
+                out = f.read()
+            self.assertEqual(out[0], 0x00)
+            self.assertTrue(FirmwareImage(out).verify_checksums(CONFIG))
+
+            with FirmwareImage.open(path, "r+") as image:
+                image.patch(0x0, b"\x00")
+                image.flush()
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(1), b"\x00")
+
+            with FirmwareImage.open(path) as image:
+                self.assertEqual(len(image), len(self.orig))
+                with self.assertRaises(TypeError):
+                    image.patch(0x0, b"\x01")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from flash_diff import changed_ranges, SECTOR_SIZE
+
+
+class TestChangedRanges(unittest.TestCase):
+    def setUp(self):
+        self.old = bytes(range(256)) * 64
+        self.new = bytearray(self.old)
+
+    def test_no_changes(self):
+        self.assertEqual(changed_ranges(self.old, self.new, 0, len(self.old) - 1), [])
+
+    def test_single_byte(self):
+        self.new[0x1234] ^= 0xFF
+        self.assertEqual(changed_ranges(self.old, self.new, 0, len(self.old) - 1), [(0x1000, 0x1FFF)])
+
+    def test_merge_adjacent(self):
+        self.new[0x1FFF] ^= 0xFF
+        self.new[0x2000] ^= 0xFF
+        self.new[0x3FFE] ^= 0xFF
+        self.assertEqual(changed_ranges(self.old, self.new, 0, len(self.old) - 1), [(0x1000, 0x3FFF)])
+
+    def test_separate(self):
+        self.new[0x0] ^= 0xFF
+        self.new[0x2000] ^= 0xFF
+        self.assertEqual(changed_ranges(self.old, self.new, 0, len(self.old) - 1), [(0x0, 0xFFF), (0x2000, 0x2FFF)])
+
+    def test_outside_range(self):
+        self.new[0x0] ^= 0xFF
+        self.new[0x3000] ^= 0xFF
+        self.assertEqual(changed_ranges(self.old, self.new, SECTOR_SIZE, 0x2FFF), [])
+
+    def test_unaligned(self):
+        with self.assertRaises(AssertionError):
+            changed_ranges(self.old, self.new, 0x10, 0x2FFF)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import unittest
+from unittest.mock import Mock
+
+from flash_transfer import max_block_size, transfer, MIN_BLOCK_SIZE
+from kwp2000 import KWP2000Client, NegativeResponseError
+
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        self.transport = Mock()
+        self.transport.recv = Mock(return_value=b"\x76")
+        self.kwp = KWP2000Client(self.transport)
+
+    def sent_blocks(self):
+        return [c.args[0][1:] for c in self.transport.send.call_args_list]
+
+    def test_max_block_size(self):
+        self.assertEqual(max_block_size(0xFF), 0xFE)
+        self.assertEqual(max_block_size(0xFFFF), 0xFFFE)
+
+    def test_transfer(self):
+        dat = bytes(range(256)) * 4
+        progress = Mock()
+
+        self.assertEqual(transfer(self.kwp, dat, 254, progress), 254)
+
+        blocks = self.sent_blocks()
+        self.assertEqual([len(b) for b in blocks], [254, 254, 254, 254, 8])
+        self.assertEqual(b"".join(blocks), dat)
+        self.assertEqual(sum(c.args[0] for c in progress.update.call_args_list), len(dat))
+
+    def test_byte_count_error(self):
+        dat = bytes(range(256)) * 2
+        self.transport.recv = Mock(side_effect=[b"\x7f\x36\x75", b"\x76", b"\x7f\x36\x79"] + [b"\x76"] * 6)
+
+        self.assertEqual(transfer(self.kwp, dat, 256), 64)
+
+        blocks = self.sent_blocks()
+        self.assertEqual([len(b) for b in blocks], [256, 128, 128] + [64] * 6)
+        self.assertEqual(b"".join(blocks[1:2] + blocks[3:]), dat)
+
+    def test_byte_count_error_minimum(self):
+        self.transport.recv = Mock(return_value=b"\x7f\x36\x75")
+
+        with self.assertRaises(NegativeResponseError):
+            transfer(self.kwp, bytes(256), MIN_BLOCK_SIZE * 4)
+        self.assertEqual(self.transport.send.call_count, 3)
+
+    def test_other_error(self):
+        self.transport.recv = Mock(return_value=b"\x7f\x36\x72")
+
+        with self.assertRaises(NegativeResponseError):
+            transfer(self.kwp, bytes(256), 128)
+        self.assertEqual(self.transport.send.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock, patch
 
-from kwp2000 import KWP2000Client, SESSION_TYPE, NegativeResponseError
+from kwp2000 import AsyncKWP2000Client, KWP2000Client, SESSION_TYPE, NegativeResponseError
 
 
 class TestKWP2000Client(unittest.TestCase):
@@ -22,6 +22,32 @@ class TestKWP2000Client(unittest.TestCase):
         with self.assertRaises(NegativeResponseError):
             self.kwp.diagnostic_session_control(SESSION_TYPE.ENGINEERING_MODE)
 
+    def test_response_pending(self):
+        self.transport.recv = Mock(side_effect=[b"\x7f\x31\x78", b"\x7f\x31\x78", b"\x71\xc4"])
+        self.kwp.erase_flash(0xA000, 0x5FFFF)
+        self.transport.send.assert_called_once_with(b"\x31\xc4\x00\xa0\x00\x05\xff\xff")
+        self.assertEqual(self.transport.recv.call_count, 3)
+
+    def test_response_pending_deadline(self):
+        self.transport.recv = Mock(return_value=b"\x7f\x31\x78")
+
+        with patch("kwp2000.time.monotonic", side_effect=range(0, 1000, 10)), self.assertRaises(NegativeResponseError) as ctx:
+            self.kwp.erase_flash(0xA000, 0x5FFFF)
+        self.assertEqual(ctx.exception.error_code, 0x78)
+        self.assertLess(self.transport.recv.call_count, 10)
+
+    def test_busy_repeat_request(self):
+        self.transport.recv = Mock(side_effect=[b"\x7f\x10\x21", b"\x50\x89"])
+        self.kwp.diagnostic_session_control(SESSION_TYPE.DIAGNOSTIC)
+        self.assertEqual(self.transport.send.call_count, 2)
+
+    def test_busy_repeat_request_retries_exhausted(self):
+        self.transport.recv = Mock(return_value=b"\x7f\x10\x21")
+
+        with patch("kwp2000.time.sleep"), self.assertRaises(NegativeResponseError) as ctx:
+            self.kwp.diagnostic_session_control(SESSION_TYPE.DIAGNOSTIC)
+        self.assertEqual(ctx.exception.error_code, 0x21)
+
     def test_request_download_one_byte_resp(self):
         self.transport.recv = Mock(return_value=b"\x74\x10")
         self.assertEqual(self.kwp.request_download(0xA000, 0x10000), 0x10)
@@ -58,5 +84,39 @@ class TestKWP2000Client(unittest.TestCase):
         self.transport.send.assert_called_once_with(b"\x82")
 
 
+class TestAsyncKWP2000Client(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.transport = AsyncMock()
+        self.kwp = AsyncKWP2000Client(self.transport)
+
+    async def test_diagnostic_session_control_ok(self):
+        self.transport.recv = AsyncMock(return_value=b"\x50\x89")
+        await self.kwp.diagnostic_session_control(SESSION_TYPE.DIAGNOSTIC)
+        self.transport.send.assert_awaited_once_with(b"\x10\x89")
+
+    async def test_diagnostic_session_control_security_access(self):
+        self.transport.recv = AsyncMock(return_value=b"\x7f\x10\x33")
+
+        with self.assertRaises(NegativeResponseError):
+            await self.kwp.diagnostic_session_control(SESSION_TYPE.ENGINEERING_MODE)
+
+    async def test_request_download_two_byte_resp(self):
+        self.transport.recv = AsyncMock(return_value=b"\x74\x01\x00")
+        self.assertEqual(await self.kwp.request_download(0xA000, 0x10000), 0x100)
+        self.transport.send.assert_awaited_once_with(b"\x34\x00\xa0\x00\x00\x01\x00\x00")
+
+    async def test_response_pending_deadline(self):
+        self.transport.recv = AsyncMock(return_value=b"\x7f\x31\x78")
+
+        with patch("kwp2000.time.monotonic", side_effect=range(0, 1000, 10)), self.assertRaises(NegativeResponseError) as ctx:
+            await self.kwp.erase_flash(0xA000, 0x5FFFF)
+        self.assertEqual(ctx.exception.error_code, 0x78)
+
+    async def test_erase_flash(self):
+        self.transport.recv = AsyncMock(return_value=b"\x71\xc4")
+        await self.kwp.erase_flash(0xA000, 0x5FFFF)
+        self.transport.send.assert_awaited_once_with(b"\x31\xc4\x00\xa0\x00\x05\xff\xff")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from kwp2000 import ACCESS_TYPE, ECU_IDENTIFICATION_TYPE, KWP2000Client, NegativeResponseError
+from metrics import Histogram, Metrics
+from simulator import SimulatedECU, SimulatedPanda
+from tp20 import TP20Transport, MessageTimeoutError
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.cumulative(), [("0.1", 2), ("1.0", 3), ("+Inf", 4)])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+        self.assertEqual(histogram.max, 2.0)
+
+    def test_quantile(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.05, 0.5, 0.5):
+            histogram.observe(value)
+
+        self.assertAlmostEqual(histogram.quantile(0.25), 0.05)
+        self.assertAlmostEqual(histogram.quantile(0.75), 0.5)
+        self.assertEqual(histogram.quantile(1.0), 0.5)
+
+        # Values in the +Inf bucket are reported as the maximum
+        histogram.observe(5.0)
+        self.assertEqual(histogram.quantile(0.99), 5.0)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_result(self):
+        metrics = Metrics(buckets=(1.0,))
+        metrics.inc("frames_total")
+        metrics.inc("frames_total", 2)
+        metrics.inc("nrc_total", label=("code", "0x78"))
+        metrics.observe("latency_seconds", 0.5, label=("service", "TRANSFER_DATA"))
+
+        result = metrics.result()
+        self.assertEqual(result["counters"], {"frames_total": 3, "nrc_total": {"0x78": 1}})
+        self.assertEqual(result["histograms"]["latency_seconds"]["TRANSFER_DATA"], {"count": 1, "sum": 0.5, "buckets": {"1.0": 1, "+Inf": 1}})
+
+    def test_prometheus(self):
+        metrics = Metrics(buckets=(1.0,))
+        metrics.inc("frames_total", 3)
+        metrics.observe("latency_seconds", 0.5, label=("service", "TRANSFER_DATA"))
+
+        expected = [
+            "# TYPE frames_total counter",
+            "frames_total 3.0",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{service="TRANSFER_DATA",le="1.0"} 1',
+            'latency_seconds_bucket{service="TRANSFER_DATA",le="+Inf"} 1',
+            'latency_seconds_sum{service="TRANSFER_DATA"} 0.5',
+            'latency_seconds_count{service="TRANSFER_DATA"} 1',
+        ]
+        self.assertEqual(metrics.prometheus(), "\n".join(expected) + "\n")
+
+    def test_session(self):
+        metrics = Metrics()
+        panda = SimulatedPanda(SimulatedECU(t3=0.0001, key_function=lambda seed: seed ^ 0x12345678))
+        tp20 = TP20Transport(panda, 0x9, keepalive=False, metrics=metrics)
+        kwp = KWP2000Client(tp20, metrics=metrics)
+
+        kwp.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        kwp.security_access(ACCESS_TYPE.PROGRAMMING_REQUEST_SEED)
+        with self.assertRaises(NegativeResponseError):
+            kwp.security_access(ACCESS_TYPE.PROGRAMMING_SEND_KEY, b"\x00\x00\x00\x00")
+        with self.assertRaises(MessageTimeoutError):
+            tp20.can_recv(timeout=0.01)
+        tp20.close()
+
+        result = metrics.result()
+        counters = result["counters"]
+        self.assertEqual(counters["tp20_frames_sent_total"], panda.frames_sent)
+        self.assertEqual(counters["tp20_frames_received_total"], panda.frames_received)
+        self.assertEqual(counters["tp20_timeouts_total"], 1)
+        self.assertEqual(counters["kwp_negative_responses_total"], {"0x35": 1})
+
+        services = result["histograms"]["kwp_request_duration_seconds"]
+        self.assertEqual(services["READ_ECU_IDENTIFICATION"]["count"], 1)
+        self.assertEqual(services["SECURITY_ACCESS"]["count"], 2)
+        self.assertGreater(result["histograms"]["tp20_ack_wait_seconds"]["count"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from patch_db import PatchDatabase, load
+
+
+class TestPatchDatabase(unittest.TestCase):
+    def setUp(self):
+        self.db = load()
+
+    def image(self, addr, value):
+        fw = bytearray(0x60000)
+        fw[addr : addr + len(value)] = value
+        return fw
+
+    def test_versions(self):
+        self.assertEqual(self.db.versions(), ["2501", "3501"])
+
+    def test_definition(self):
+        definition = self.db["3501"]
+        self.assertEqual(definition.part_number, "1K0909144R")
+        self.assertEqual(definition.patches[0], (0x5D828, b"1K0909144R \x003501", None))
+        self.assertIn((0x5D2FA, b"\x14", b"\x00"), definition.patches)
+        self.assertEqual(definition.checksums[1], (0x5DFFE, 0x5CFFF, 0x5DFFC))
+        self.assertIs(self.db["3501"], definition)
+
+    def test_detect(self):
+        fw = self.image(0x5E7A8, b"1K0909144E \x002501")
+        self.assertEqual(self.db.detect(fw).version, "2501")
+
+        fw = self.image(0x5D828, b"1K0909144R \x003501")
+        self.assertEqual(self.db.detect(memoryview(fw)).version, "3501")
+
+    def test_detect_unknown(self):
+        self.assertIsNone(self.db.detect(self.image(0x5E7A8, b"1K0909144E \x002502")))
+        self.assertIsNone(self.db.detect(bytes(0x100)))
+
+    def test_lazy(self):
+        entry = {
+            "part_number": "1K0909144X",
+            "software_version": "9999",
+            "signature": {"address": "0x100", "value": "00ff"},
+            "patches": [],
+            "checksums": [],
+        }
+        db = PatchDatabase({"9999": entry, "broken": {"signature": {"address": "0x200", "value": "ff"}}})
+
+        fw = bytearray(0x300)
+        fw[0x101] = 0xFF
+        self.assertEqual(db.detect(fw).version, "9999")
+        self.assertEqual(list(db.definitions), ["9999"])
+
+    def test_load_cached(self):
+        self.assertIs(load(), self.db)
+
+
+if __name__ == "__main__":
+    unittest.main()
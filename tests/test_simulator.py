@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from checksum import sum16
+from flash_transfer import transfer
+from kwp2000 import ACCESS_TYPE, ECU_IDENTIFICATION_TYPE, ROUTINE_CONTROL_TYPE, SESSION_TYPE, KWP2000Client, NegativeResponseError
+from simulator import SimulatedECU, SimulatedPanda, BACKGROUND_ADDRS
+from tp20 import RECONNECT_SILENCE_WINDOW, TP20Transport, MessageTimeoutError
+
+
+def key_function(seed):
+    return seed ^ 0x12345678
+
+
+class TestSimulator(unittest.TestCase):
+    def setUp(self):
+        self.ecu = SimulatedECU(t3=0.0001, erase_time=0.05, reboot_time=0.05, key_function=key_function)
+        self.panda = SimulatedPanda(self.ecu)
+        self.connect()
+
+    def tearDown(self):
+        self.tp20.close()
+
+    def connect(self):
+        self.tp20 = TP20Transport(self.panda, 0x9)
+        self.kwp = KWP2000Client(self.tp20)
+
+    def unlock(self):
+        self.kwp.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+        self.tp20.close()
+
+        # The ECU doesn't respond while rebooting
+        with self.assertRaises(MessageTimeoutError):
+            self.connect()
+        time.sleep(self.ecu.reboot_time)
+        self.connect()
+
+        seed = self.kwp.security_access(ACCESS_TYPE.PROGRAMMING_REQUEST_SEED)
+        key = key_function(int.from_bytes(seed, "big")).to_bytes(4, "big")
+        self.kwp.security_access(ACCESS_TYPE.PROGRAMMING_SEND_KEY, key)
+
+    def test_timing_parameters(self):
+        self.assertEqual(self.tp20.tx_addr, 0x7A8)
+        self.assertAlmostEqual(self.tp20.t3, 0.0001)
+
+    def test_identification(self):
+        ident = self.kwp.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        self.assertEqual(ident, self.ecu.ident)
+
+    def test_invalid_key(self):
+        self.kwp.security_access(ACCESS_TYPE.PROGRAMMING_REQUEST_SEED)
+        with self.assertRaises(NegativeResponseError) as e:
+            self.kwp.security_access(ACCESS_TYPE.PROGRAMMING_SEND_KEY, b"\x00\x00\x00\x00")
+        self.assertEqual(e.exception.error_code, 0x35)
+
+    def test_reconnect(self):
+        self.ecu.reboot_time = 0.15
+        self.kwp.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+
+        probes = []
+        open_channel = self.tp20.open_channel
+
+        def probe(*args):
+            probes.append(time.monotonic())
+            return open_channel(*args)
+
+        with patch.object(self.tp20, "open_channel", side_effect=probe):
+            self.tp20.reconnect()
+
+        # Not probed before the ECU went silent, and probed once as soon as its status frame is back
+        self.assertGreaterEqual(probes[0], self.ecu.offline_until - self.ecu.reboot_time + RECONNECT_SILENCE_WINDOW)
+        self.assertEqual(len([t for t in probes if t >= self.ecu.offline_until]), 1)
+
+        ident = self.kwp.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        self.assertEqual(ident, self.ecu.ident)
+
+    def test_reconnect_setup_rejected(self):
+        self.kwp.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+
+        # The bootloader rejects the first channel setup after the reboot
+        handle_setup = self.ecu.handle_setup
+        replies = [[(0x209, b"\x00\xd6\x00\x03\xa8\x07\x01", 0.0)]]
+
+        def setup(dat):
+            return replies.pop(0) if replies else handle_setup(dat)
+
+        with patch.object(self.ecu, "handle_setup", side_effect=setup) as mock_setup:
+            self.tp20.reconnect()
+        self.assertEqual(mock_setup.call_count, 2)
+
+        ident = self.kwp.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+        self.assertEqual(ident, self.ecu.ident)
+
+    def test_reconnect_timeout(self):
+        self.ecu.reboot_time = 1.0
+        self.kwp.diagnostic_session_control(SESSION_TYPE.PROGRAMMING)
+
+        start = time.monotonic()
+        with self.assertRaises(MessageTimeoutError):
+            self.tp20.reconnect(timeout=0.2)
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_locked(self):
+        with self.assertRaises(NegativeResponseError) as e:
+            self.kwp.erase_flash(0x5E000, 0x5EFFF)
+        self.assertEqual(e.exception.error_code, 0x33)
+
+    def test_flash(self):
+        self.unlock()
+        dat = os.urandom(0x1000)
+
+        self.assertEqual(self.kwp.request_download(0x5E000, len(dat)), 0xFF)
+        self.kwp.erase_flash(0x5E000, 0x5EFFF)
+
+        # The ECU replies with responsePending until the erase is done
+        self.assertEqual(self.kwp.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.ERASE_FLASH), b"\x00")
+        self.assertEqual(self.ecu.flash[0x5E000:0x5F000], b"\xff" * 0x1000)
+
+        transfer(self.kwp, dat, 0xFE)
+        self.kwp.request_transfer_exit()
+        self.assertEqual(self.ecu.flash[0x5E000:0x5F000], dat)
+
+        self.kwp.calculate_flash_checksum(0x5E000, 0x5EFFF, sum16(dat))
+        self.assertEqual(self.kwp.request_routine_results_by_local_identifier(ROUTINE_CONTROL_TYPE.CALCULATE_FLASH_CHECKSUM), b"\x00")
+
+    def test_block_too_long(self):
+        self.ecu.max_block_length = 0x40
+        self.unlock()
+
+        self.kwp.request_download(0x5E000, 0x100)
+        self.assertEqual(transfer(self.kwp, b"\x00" * 0x100, 0xFE), 0x3F)
+
+
+class TestSimulatedBus(unittest.TestCase):
+    def test_frame_loss(self):
+        ecu = SimulatedECU(t3=0.0001)
+        panda = SimulatedPanda(ecu, loss=0.3, seed=1)
+
+        with TP20Transport(panda, 0x9) as tp20:
+            kwp = KWP2000Client(tp20)
+            for _ in range(5):
+                self.assertEqual(kwp.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), ecu.ident)
+
+            self.assertGreater(panda.frames_lost, 0)
+            self.assertEqual(tp20.frames_recovered, tp20.frames_lost)
+
+    def test_bus_load(self):
+        ecu = SimulatedECU(t3=0.0001)
+        panda = SimulatedPanda(ecu, bus_load=0.5)
+
+        with TP20Transport(panda, 0x9) as tp20:
+            kwp = KWP2000Client(tp20)
+            self.assertEqual(kwp.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), ecu.ident)
+
+            # Other traffic is queued by the dispatcher
+            self.assertGreater(sum(len(tp20.dispatcher.msgs[a]) for a in BACKGROUND_ADDRS), 0)
+
+    def test_bulk_send(self):
+        ecu = SimulatedECU(t3=0.0)
+        panda = SimulatedPanda(ecu)
+
+        with TP20Transport(panda, 0x9) as tp20:
+            self.assertTrue(tp20.bulk_send)
+            kwp = KWP2000Client(tp20)
+
+            # Two frame request, denied outside of the programming session
+            with self.assertRaises(NegativeResponseError):
+                kwp.erase_flash(0x5E000, 0x5EFFF)
+            self.assertEqual(ecu.requests, {0x31: 1})
+
+    def test_latency(self):
+        ecu = SimulatedECU(t3=0.0001)
+        panda = SimulatedPanda(ecu, latency=0.02)
+
+        with TP20Transport(panda, 0x9) as tp20:
+            kwp = KWP2000Client(tp20)
+            start = time.monotonic()
+            kwp.read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.STATUS_FLASH)
+            self.assertGreaterEqual(time.monotonic() - start, 0.02)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+import unittest
+from unittest.mock import Mock
+
+from metrics import Metrics
+from tp20 import AsyncTP20Transport, BusDispatcher, TP20Transport, ChannelClosedError, MessageTimeoutError, decode_timing, encode_timing
+
+
+class FakePanda:
+    """Returns queued batches of frames from can_recv, and nothing once empty.
+    Replies are only released after a frame was sent."""
+
+    def __init__(self, *replies):
+        self.batches = []
+        self.replies = list(replies)
+        self.sent = []
+
+    def push(self, *msgs):
+        self.batches.append(list(msgs))
+
+    def can_send(self, addr, dat, bus, timeout=0):
+        self.sent.append((addr, dat))
+        if self.replies:
+            reply = self.replies.pop(0)
+            if reply:
+                self.batches.append(reply)
+
+    def can_recv(self):
+        return self.batches.pop(0) if self.batches else []
+
+
+class FakeBulkPanda(FakePanda):
+    """Also supports bulk sends, each bulk send releases one reply batch"""
+
+    def __init__(self, *replies):
+        super().__init__(*replies)
+        self.bulk = []
+
+    def can_send_many(self, arr, timeout=0):
+        self.bulk.append([(addr, dat) for addr, _, dat, _ in arr])
+        self.can_send(None, None, 0)
+        self.sent.pop()
+
+
+class TestTP20Transport(unittest.TestCase):
+    def setUp(self):
+        self.panda = FakePanda(
+            [(0x209, 0, b"\x00\xd0\x00\x03\xa8\x07\x01", 0)],
+            [(0x300, 0, b"\xa1\x0f\x8a\xff\x4a\xff", 0)],
+        )
+        self.tp20 = TP20Transport(self.panda, 0x9, keepalive=False)
+        self.panda.sent.clear()
+
+    def tearDown(self):
+        self.tp20.close()
+
+    def test_open_channel(self):
+        self.assertEqual(self.tp20.rx_addr, 0x300)
+        self.assertEqual(self.tp20.tx_addr, 0x7A8)
+
+    def test_timing_parameters(self):
+        self.assertEqual(self.panda.replies, [])
+        self.assertEqual(self.tp20.block_size, 0x0F)
+        self.assertAlmostEqual(self.tp20.t1, 0.1)
+        self.assertAlmostEqual(self.tp20.time_between_packets, 0.01)
+
+    def test_encode_decode_timing(self):
+        self.assertAlmostEqual(decode_timing(0x8A), 0.1)
+        self.assertAlmostEqual(decode_timing(0x4A), 0.01)
+        self.assertAlmostEqual(decode_timing(0x0A), 0.001)
+        self.assertEqual(encode_timing(0.1), 0x8A)
+        self.assertEqual(encode_timing(0.001), 0x0A)
+        self.assertEqual(encode_timing(0.0005), 0x05)
+        with self.assertRaises(ValueError):
+            encode_timing(10.0)
+
+    def test_can_recv_buffers_other_addresses(self):
+        self.panda.push((0x123, 0, b"\x01", 0), (0x300, 0, b"\x02", 1), (0x300, 0, b"\x03", 0), (0x300, 0, b"\x04", 0))
+        self.assertEqual(self.tp20.can_recv(), b"\x03")
+        self.assertEqual(self.tp20.can_recv(), b"\x04")
+        self.assertEqual(self.tp20.can_recv(0x123), b"\x01")
+
+    def test_can_recv_timeout(self):
+        self.panda.push((0x123, 0, b"\x01", 0))
+        with self.assertRaises(MessageTimeoutError):
+            self.tp20.can_recv()
+
+    def test_can_recv_blocks_until_frame(self):
+        self.tp20.timeout = 1.0
+        timer = threading.Timer(0.05, self.panda.push, [(0x300, 0, b"\x05", 0)])
+        timer.start()
+
+        start = time.monotonic()
+        self.assertEqual(self.tp20.can_recv(), b"\x05")
+        self.assertLess(time.monotonic() - start, 0.5)
+        timer.join()
+
+    def test_can_recv_reader_error(self):
+        self.panda.can_recv = Mock(side_effect=IOError("usb error"))
+        with self.assertRaises(IOError):
+            self.tp20.can_recv()
+
+    def test_send_single_frame(self):
+        self.panda.replies = [[(0x300, 0, b"\xb1", 0)]]
+        self.tp20.send(b"\x10\x89")
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\x10\x00\x02\x10\x89")])
+        self.assertEqual(self.tp20.tx_seq, 1)
+
+    def test_send_blocks(self):
+        self.tp20.block_size = 2
+        dat = bytes(range(20))
+        self.panda.replies = [[], [(0x300, 0, b"\xb2", 0)], [], [(0x300, 0, b"\xb4", 0)]]
+        self.tp20.send(dat)
+
+        opcodes = [frame[0] for _, frame in self.panda.sent]
+        self.assertEqual(opcodes, [0x20, 0x01, 0x22, 0x13])
+        self.assertEqual(b"".join(frame[1:] for _, frame in self.panda.sent), b"\x00\x14" + dat)
+
+    def test_send_long(self):
+        self.tp20.block_size = 0x0F
+        self.tp20.time_between_packets = 0.0
+        dat = bytes(1000)
+        frames = (len(dat) + 2 + 6) // 7
+        self.panda.replies = [[(0x300, 0, bytes([0xB0 | ((i + 1) & 0xF)]), 0)] if (i + 1) % 0x0F == 0 or i == frames - 1 else [] for i in range(frames)]
+        self.tp20.send(dat)
+        self.assertEqual(len(self.panda.sent), frames)
+
+    def test_no_bulk_send(self):
+        # Not supported by the panda, and T3 is too long
+        self.assertFalse(self.tp20.bulk_send)
+
+    def test_send_wrong_ack(self):
+        self.panda.replies = [[(0x300, 0, b"\xb5", 0)]]
+        with self.assertRaises(RuntimeError):
+            self.tp20.send(b"\x10\x89")
+
+    def test_send_channel_closed(self):
+        self.panda.replies = [[(0x300, 0, b"\xa8", 0)]]
+        with self.assertRaises(ChannelClosedError):
+            self.tp20.send(b"\x10\x89")
+        self.assertFalse(self.tp20.connected)
+
+    def test_recv_channel_closed(self):
+        self.panda.push((0x300, 0, b"\x20\x00\x08\x5a\x9b\x31\x4b\x30", 0), (0x300, 0, b"\xa8", 0))
+        with self.assertRaises(ChannelClosedError):
+            self.tp20.recv()
+        self.assertFalse(self.tp20.connected)
+
+    def test_recv(self):
+        self.panda.push((0x300, 0, b"\x20\x00\x08\x5a\x9b\x31\x4b\x30", 0), (0x300, 0, b"\x11\x39\x30\x39", 0))
+        self.assertEqual(self.tp20.recv(), b"\x5a\x9b1K0909")
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\xb2")])
+
+    def test_recv_ack_blocks(self):
+        self.panda.push((0x300, 0, b"\x00\x00\x08\x5a\x9b\x31\x4b\x30", 0), (0x300, 0, b"\x31\x39\x30\x39", 0))
+        self.assertEqual(self.tp20.recv(), b"\x5a\x9b1K0909")
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\xb1")])
+
+    def test_recv_lost_frame(self):
+        # Frame with sequence 1 is lost, ECU retransmits after our ack with sequence 1
+        self.panda.push((0x300, 0, b"\x20\x00\x0c\x5a\x9b\x31\x4b\x30", 0), (0x300, 0, b"\x02\x34\x34\x20", 0))
+        self.panda.replies = [[(0x300, 0, b"\x21\x39\x30\x39\x31", 0), (0x300, 0, b"\x12\x34\x34\x20", 0)]]
+        self.assertEqual(self.tp20.recv(), b"\x5a\x9b1K0909144 ")
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\xb1"), (0x7A8, b"\xb3")])
+        self.assertEqual(self.tp20.frames_lost, 1)
+        self.assertEqual(self.tp20.frames_recovered, 1)
+
+    def test_recv_duplicate_frame(self):
+        # Our ack of the first block was lost, the ECU resends its last frame
+        self.panda.push((0x300, 0, b"\x00\x00\x0c\x5a\x9b\x31\x4b\x30", 0), (0x300, 0, b"\x00\x00\x0c\x5a\x9b\x31\x4b\x30", 0))
+        self.panda.replies = [None, [(0x300, 0, b"\x21\x39\x30\x39\x31", 0), (0x300, 0, b"\x12\x34\x34\x20", 0)]]
+        self.assertEqual(self.tp20.recv(), b"\x5a\x9b1K0909144 ")
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\xb1"), (0x7A8, b"\xb1"), (0x7A8, b"\xb3")])
+        self.assertEqual(self.tp20.frames_lost, 0)
+        self.assertEqual(self.tp20.frames_recovered, 0)
+
+    def test_recv_ignores_non_data_frames(self):
+        self.panda.push((0x300, 0, b"\x20\x00\x08\x5a\x9b\x31\x4b\x30", 0), (0x300, 0, b"\xa3", 0), (0x300, 0, b"\x11\x39\x30\x39", 0))
+        self.assertEqual(self.tp20.recv(), b"\x5a\x9b1K0909")
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\xb2")])
+        self.assertEqual(self.tp20.frames_lost, 0)
+
+    def test_recv_lost_last_frame(self):
+        self.panda.push((0x300, 0, b"\x20\x00\x08\x5a\x9b\x31\x4b\x30", 0))
+        self.panda.replies = [[(0x300, 0, b"\x11\x39\x30\x39", 0)]]
+        self.assertEqual(self.tp20.recv(), b"\x5a\x9b1K0909")
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\xb1"), (0x7A8, b"\xb2")])
+
+    def test_recv_retries_exhausted(self):
+        self.panda.push((0x300, 0, b"\x20\x00\x08\x5a\x9b\x31\x4b\x30", 0))
+        with self.assertRaises(MessageTimeoutError):
+            self.tp20.recv()
+
+    def test_keepalive(self):
+        self.panda.replies = [[(0x300, 0, b"\xa1\x0f\x8a\xff\x4a\xff", 0)]]
+        self.tp20.metrics = Metrics()
+        self.tp20.keepalive = True
+        time.sleep(0.12)
+        self.tp20.keepalive = False
+
+        self.assertEqual(self.panda.sent[0], (0x7A8, b"\xa3"))
+        self.assertFalse(self.tp20.keepalive_pending)
+        self.assertEqual(self.tp20.metrics.result()["counters"]["tp20_keepalives_total"], len(self.panda.sent))
+        with self.assertRaises(MessageTimeoutError):
+            self.tp20.can_recv()
+
+    def test_reopen_after_missed_keepalive(self):
+        self.tp20.keepalive = True
+        time.sleep(0.12)
+        self.tp20.keepalive = False
+        self.assertEqual(self.panda.sent[0], (0x7A8, b"\xa3"))
+        self.assertTrue(self.tp20.keepalive_pending)
+
+        self.panda.replies = [
+            [(0x209, 0, b"\x00\xd0\x00\x03\xa8\x07\x01", 0)],
+            [(0x300, 0, b"\xa1\x0f\x8a\xff\x4a\xff", 0)],
+        ]
+        self.tp20.open_channel(0x9)
+        self.assertTrue(self.tp20.connected)
+
+
+class TestBulkSend(unittest.TestCase):
+    def setUp(self):
+        self.panda = FakeBulkPanda(
+            [(0x209, 0, b"\x00\xd0\x00\x03\xa8\x07\x01", 0)],
+            [(0x300, 0, b"\xa1\x0f\x8a\xff\x00\xff", 0)],
+        )
+        self.tp20 = TP20Transport(self.panda, 0x9, keepalive=False)
+        self.panda.sent.clear()
+
+    def tearDown(self):
+        self.tp20.close()
+
+    def test_send_blocks(self):
+        self.assertTrue(self.tp20.bulk_send)
+
+        self.tp20.block_size = 4
+        dat = bytes(range(40))
+        self.panda.replies = [[], [(0x300, 0, b"\xb4", 0)], [], [(0x300, 0, b"\xb6", 0)]]
+        self.tp20.send(dat)
+
+        # Frames without ack are sent in bulk, frames waiting for an ack on their own
+        self.assertEqual([[frame[0] for _, frame in frames] for frames in self.panda.bulk], [[0x20, 0x21, 0x22], [0x24]])
+        self.assertEqual([frame[0] for _, frame in self.panda.sent], [0x03, 0x15])
+
+        frames = self.panda.bulk[0] + self.panda.sent[:1] + self.panda.bulk[1] + self.panda.sent[1:]
+        self.assertEqual(b"".join(frame[1:] for _, frame in frames), b"\x00\x28" + dat)
+        self.assertEqual(self.tp20.tx_seq, 6)
+
+    def test_send_single_frame(self):
+        self.panda.replies = [[(0x300, 0, b"\xb1", 0)]]
+        self.tp20.send(b"\x10\x89")
+        self.assertEqual(self.panda.bulk, [])
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\x10\x00\x02\x10\x89")])
+
+
+class TestBusDispatcher(unittest.TestCase):
+    def test_multiple_channels(self):
+        panda = FakePanda(
+            [(0x209, 0, b"\x00\xd0\x00\x03\xa8\x07\x01", 0)],
+            [(0x300, 0, b"\xa1\x0f\x8a\xff\x4a\xff", 0)],
+            [(0x201, 0, b"\x00\xd0\x01\x03\x40\x07\x01", 0)],
+            [(0x301, 0, b"\xa1\x0f\x8a\xff\x4a\xff", 0)],
+        )
+
+        with BusDispatcher(panda) as dispatcher:
+            eps = dispatcher.open_channel(0x9, keepalive=False)
+            engine = dispatcher.open_channel(0x1, keepalive=False)
+
+            self.assertEqual((eps.rx_addr, eps.tx_addr), (0x300, 0x7A8))
+            self.assertEqual((engine.rx_addr, engine.tx_addr), (0x301, 0x740))
+            self.assertEqual(panda.sent[2], (0x200, b"\x01\xc0\x00\x10\x01\x03\x01"))
+
+            panda.push((0x301, 0, b"\x10\x00\x01\x01", 0), (0x300, 0, b"\x10\x00\x01\x09", 0))
+            self.assertEqual(eps.recv(), b"\x09")
+            self.assertEqual(engine.recv(), b"\x01")
+
+            eps.close()
+            self.assertEqual(dispatcher.register(eps), 0x300)
+
+
+class TestAsyncTP20Transport(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.panda = FakePanda(
+            [(0x209, 0, b"\x00\xd0\x00\x03\xa8\x07\x01", 0)],
+            [(0x300, 0, b"\xa1\x0f\x8a\xff\x4a\xff", 0)],
+        )
+        self.tp20 = await AsyncTP20Transport.create(self.panda, 0x9, keepalive=False)
+        self.panda.sent.clear()
+
+    async def asyncTearDown(self):
+        self.tp20.close()
+
+    async def test_open_channel(self):
+        self.assertEqual(self.tp20.rx_addr, 0x300)
+        self.assertEqual(self.tp20.tx_addr, 0x7A8)
+        self.assertAlmostEqual(self.tp20.time_between_packets, 0.01)
+
+    async def test_send_recv(self):
+        self.panda.replies = [[(0x300, 0, b"\xb1", 0), (0x300, 0, b"\x10\x00\x02\x50\x89", 0)]]
+        await self.tp20.send(b"\x10\x89")
+        self.assertEqual(await self.tp20.recv(), b"\x50\x89")
+        self.assertEqual(self.panda.sent, [(0x7A8, b"\x10\x00\x02\x10\x89"), (0x7A8, b"\xb1")])
+
+    async def test_can_recv_timeout(self):
+        with self.assertRaises(MessageTimeoutError):
+            await self.tp20.can_recv()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from can_trace import RX, TX, RecordingPanda, ReplayPanda, TraceRecorder, read_trace
+from kwp2000 import ECU_IDENTIFICATION_TYPE, KWP2000Client
+from simulator import STATUS_ADDR, SimulatedECU, SimulatedPanda
+from tp20 import TP20Transport
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".trace")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def record_session(self) -> bytes:
+        ecu = SimulatedECU(t3=0.0001)
+        with TraceRecorder(self.path) as recorder:
+            tp20 = TP20Transport(RecordingPanda(SimulatedPanda(ecu), recorder), 0x9, keepalive=False)
+            ident = KWP2000Client(tp20).read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT)
+            tp20.close()
+        return ident
+
+    def test_record(self):
+        self.record_session()
+
+        records = [record for record in read_trace(self.path) if record[2] != STATUS_ADDR]
+        self.assertEqual(records[0][1:], (TX, 0x200, 0, b"\x09\xc0\x00\x10\x00\x03\x01"))
+        self.assertEqual(records[1][1:3], (RX, 0x209))
+        self.assertTrue(all(a[0] <= b[0] for a, b in zip(records, records[1:])))
+
+    def test_replay(self):
+        ident = self.record_session()
+
+        panda = ReplayPanda(self.path, speed=0)
+        tp20 = TP20Transport(panda, 0x9, keepalive=False)
+        self.assertEqual(KWP2000Client(tp20).read_ecu_identifcation(ECU_IDENTIFICATION_TYPE.ECU_IDENT), ident)
+        tp20.close()
+
+        self.assertTrue(panda.done())
+        self.assertEqual(panda.sent, [(addr, dat) for _, direction, addr, _, dat in read_trace(self.path) if direction == TX])
+
+    def test_ring_full(self):
+        recorder = TraceRecorder(self.path, capacity=4, flush_interval=10)
+        for i in range(6):
+            recorder.record(TX, 0x300, bytes([i]), 0)
+        self.assertEqual(recorder.dropped, 2)
+
+        recorder.close()
+        self.assertEqual([dat for _, _, _, _, dat in read_trace(self.path)], [b"\x00", b"\x01", b"\x02", b"\x03"])
+
+    def test_wraparound(self):
+        recorder = TraceRecorder(self.path, capacity=4, flush_interval=10)
+        for i in range(10):
+            recorder.record(TX, 0x300, bytes([i]), 0)
+            recorder.flush()
+        recorder.close()
+
+        self.assertEqual([dat for _, _, _, _, dat in read_trace(self.path)], [bytes([i]) for i in range(10)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,86 +6,496 @@ Reference: https://jazdw.net/tp20
 
 import time
 import struct
-from typing import Optional, List, Tuple
+import asyncio
+import threading
+from collections import defaultdict, deque
+from typing import Optional, Callable, DefaultDict, Deque, Dict, Iterator, List, Set, Tuple
 
 from panda import Panda  # type: ignore
 
+from metrics import Metrics
+
 
 BROADCAST_ADDR = 0x200
 
+# Channels ask the ECU to transmit on 0x300, 0x301, ...
+CHANNEL_RX_ADDR = 0x300
+
+# Maximum number of frames buffered per arbitration ID. Frames on addresses
+# nobody reads from would otherwise pile up forever on a busy bus.
+MAX_QUEUED_MSGS = 256
+
+# Time the reader thread sleeps when the panda has no new frames
+RX_POLL_INTERVAL = 0.001
+
+# Number of times a retransmission is requested when a message stalls
+MAX_RX_RETRIES = 3
+
+# A channel test is sent when the channel was idle for this fraction of T1
+KEEPALIVE_MARGIN = 0.8
+
+# Messages are prefixed with a two byte length
+MAX_MESSAGE_SIZE = 0xFFFF
+
+# Frames that don't need an ack are submitted to the panda in one bulk transfer
+# when the ECU allows this little time between frames. The panda puts them on
+# the bus back to back, an 8 byte frame takes about 0.22ms at 500 kbit/s.
+BULK_SEND_MAX_T3 = 0.0002
+
+# Channel setup is probed at growing intervals while the ECU reboots
+RECONNECT_TIMEOUT = 10.0
+RECONNECT_MIN_INTERVAL = 0.01
+RECONNECT_MAX_INTERVAL = 0.5
+RECONNECT_BACKOFF = 1.5
+
+# Time to wait for the setup response of a probe. An ECU that is running
+# answers within a few milliseconds.
+RECONNECT_PROBE_TIMEOUT = 0.05
+
+# Time before the first probe, so the channel isn't opened right before the
+# ECU resets. Addresses that were active before a reconnect and got no frames
+# during this time are assumed to belong to the rebooting ECU.
+RECONNECT_SILENCE_WINDOW = 0.1
+
+# Units of the timing parameter bytes, selected by the upper two bits
+TIMING_UNITS = (0.0001, 0.001, 0.01, 0.1)
+
 
 class MessageTimeoutError(TimeoutError):
     pass
 
 
-class TP20Transport:
-    def __init__(self, panda: Panda, module: int, bus: int = 0, timeout: float = 0.1, debug: bool = False):
-        """Create TP20Transport object and open a channel"""
+class ChannelClosedError(ConnectionError):
+    """The ECU sent a disconnect (0xA8)"""
+
+
+def decode_timing(param: int) -> float:
+    """Decode a timing parameter byte into seconds. The upper two bits
+    select the unit (0.1ms, 1ms, 10ms or 100ms), the lower six bits
+    are the scale."""
+    return TIMING_UNITS[param >> 6] * (param & 0x3F)
+
+
+def encode_timing(seconds: float) -> int:
+    """Encode seconds into a timing parameter byte using the
+    smallest unit that can represent it"""
+    for unit, size in enumerate(TIMING_UNITS):
+        scale = round(seconds / size)
+        if scale <= 0x3F:
+            return (unit << 6) | scale
+    raise ValueError(f"Timing parameter {seconds}s out of range")
+
+
+class BusDispatcher:
+    def __init__(self, panda: Panda, bus: int = 0, debug: bool = False):
+        """Owns the receive side of the panda. Frames are read in a background
+        thread and routed into queues per arbitration ID, so any number of
+        TP 2.0 channels can share one panda."""
+        self.panda = panda
+        self.bus = bus
+        self.debug = debug
+        self.msgs: DefaultDict[int, Deque[bytes]] = defaultdict(lambda: deque(maxlen=MAX_QUEUED_MSGS))
+        self.channels: Dict[int, "TP20Channel"] = {}
+        self.listeners: DefaultDict[int, List[Callable[[], None]]] = defaultdict(list)
+
+        # Serializes access to panda.can_send between channels
+        self.tx_lock = threading.Lock()
+
+        # Callers block on the condition until a frame for their address arrives
+        self.rx_cond = threading.Condition()
+        self.rx_error: Optional[Exception] = None
+        self.running = True
+        self.rx_thread = threading.Thread(target=self.rx_loop, daemon=True)
+        self.rx_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop the reader thread. The panda can be used by
+        other clients or a new dispatcher afterwards."""
+        self.running = False
+        if self.rx_thread is not threading.current_thread():
+            self.rx_thread.join()
+
+    def open_channel(self, module: int, **kwargs) -> "TP20Transport":
+        """Open a channel to a module that shares this dispatcher"""
+        return TP20Transport(self.panda, module, bus=self.bus, dispatcher=self, **kwargs)
+
+    async def open_async_channel(self, module: int, **kwargs) -> "AsyncTP20Transport":
+        """Open an asyncio channel to a module that shares this dispatcher"""
+        return await AsyncTP20Transport.create(self.panda, module, bus=self.bus, dispatcher=self, **kwargs)
+
+    def register(self, channel: "TP20Channel") -> int:
+        """Reserve the lowest free RX address starting at 0x300 for a channel"""
+        with self.rx_cond:
+            rx_addr = CHANNEL_RX_ADDR
+            while rx_addr in self.channels:
+                rx_addr += 1
+
+            self.channels[rx_addr] = channel
+            self.msgs[rx_addr].clear()
+            return rx_addr
+
+    def unregister(self, rx_addr: int):
+        with self.rx_cond:
+            self.channels.pop(rx_addr, None)
+
+    def add_listener(self, addr: int, callback: Callable[[], None]):
+        """Call callback from the reader thread whenever a frame
+        for addr was queued"""
+        with self.rx_cond:
+            self.listeners[addr].append(callback)
+
+    def remove_listener(self, addr: int, callback: Callable[[], None]):
+        with self.rx_cond:
+            if callback in self.listeners[addr]:
+                self.listeners[addr].remove(callback)
+
+    def clear(self, addr: int):
+        with self.rx_cond:
+            self.msgs[addr].clear()
+
+    def active_addrs(self) -> Set[int]:
+        """Addresses with queued frames"""
+        with self.rx_cond:
+            return {addr for addr, queue in self.msgs.items() if queue}
+
+    def wait_any(self, addrs: Set[int], timeout: float) -> bool:
+        """Wait until a frame is queued for any of addrs. Returns False
+        on timeout, without raising."""
+        deadline = time.monotonic() + timeout
+        with self.rx_cond:
+            while not any(self.msgs.get(addr) for addr in addrs):
+                if self.rx_error is not None:
+                    raise self.rx_error
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.rx_cond.wait(remaining)
+
+            return True
+
+    def rx_loop(self):
+        while self.running:
+            try:
+                msgs = self.panda.can_recv()
+            except Exception as e:
+                with self.rx_cond:
+                    self.rx_error = e
+                    self.rx_cond.notify_all()
+                    for callbacks in self.listeners.values():
+                        for callback in callbacks:
+                            callback()
+                return
+
+            for channel in list(self.channels.values()):
+                channel.keep_alive()
+
+            if not msgs:
+                time.sleep(RX_POLL_INTERVAL)
+                continue
+
+            with self.rx_cond:
+                for a, _, dat, bus in msgs:
+                    if bus != self.bus:
+                        continue
+
+                    channel = self.channels.get(a)
+                    if channel is not None and not channel.filter_frame(dat):
+                        continue
+
+                    self.msgs[a].append(dat)
+                    for callback in self.listeners.get(a, ()):
+                        callback()
+                self.rx_cond.notify_all()
+
+    def try_recv(self, addr: int) -> Optional[bytes]:
+        """Return the oldest queued message for addr, or None"""
+        with self.rx_cond:
+            if self.rx_error is not None:
+                raise self.rx_error
+
+            queue = self.msgs.get(addr)
+            return queue.popleft() if queue else None
+
+    def recv(self, addr: int, timeout: float) -> bytes:
+        """Wait until a message with the specified address is received.
+        Messages on other addresses, or a second message with the
+        specified address, will be stored per address and are
+        returned on subsequent calls."""
+        deadline = time.monotonic() + timeout
+        with self.rx_cond:
+            queue = self.msgs[addr]
+            while not queue:
+                if self.rx_error is not None:
+                    raise self.rx_error
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise MessageTimeoutError("Timed out waiting for message")
+                self.rx_cond.wait(remaining)
+
+            return queue.popleft()
+
+    def send(self, addr: int, dat: bytes, timeout: float):
+        with self.tx_lock:
+            self.panda.can_send(addr, dat, self.bus, int(timeout * 1000))
+
+    def send_many(self, addr: int, dats: List[bytes], timeout: float):
+        with self.tx_lock:
+            self.panda.can_send_many([[addr, None, dat, self.bus] for dat in dats], timeout=int(timeout * 1000))
+
+
+class MessageBuffer:
+    def __init__(self, channel: "TP20Channel"):
+        """Reassembles the chunks of one received message. The buffer is
+        allocated once using the length in the first chunk.
+
+        Chunks with an unexpected sequence number are dropped. Chunks behind
+        the expected one are duplicates and aren't counted as lost. When the
+        sender waits for an ack, or the message stalls, the channel acks with
+        the sequence number we expect so the sender retransmits from there."""
+        self.channel = channel
+        self.data: Optional[bytearray] = None
+        self.length = 0
+        self.received = 0
+        self.missing = 0
+        self.retries = 0
+        self.done = False
+
+    def feed(self, dat: bytes) -> bool:
+        """Add a chunk, returns True if the sender waits for an ack"""
+        channel = self.channel
+        typ, seq = dat[0] >> 4, dat[0] & 0xF
+
+        if dat[0] == 0xA8:
+            channel.handle_disconnect()
+
+        # Not a data frame, e.g. a stray channel parameters frame
+        if typ > 0x3:
+            return False
+
+        wants_ack = typ in (0x0, 0x1)
+
+        if seq != channel.rx_seq:
+            # A frame that was already received, e.g. resent after our ack got lost
+            if 0 < (channel.rx_seq - seq) & 0xF <= 8:
+                return wants_ack
+
+            if not self.missing:
+                self.missing = (seq - channel.rx_seq) & 0xF
+                channel.frames_lost += self.missing
+                if channel.debug:
+                    print(f"Expected sequence {channel.rx_seq}, got {seq}. Requesting retransmission")
+            return wants_ack
+
+        if self.missing:
+            channel.frames_recovered += self.missing
+            self.missing = 0
+
+        channel.rx_seq = (seq + 1) & 0xF
+
+        chunk = memoryview(dat)[1:]
+        if self.data is None:
+            self.length = struct.unpack(">H", chunk[:2])[0]
+            self.data = bytearray(self.length)
+            chunk = chunk[2:]
+
+        n = min(len(chunk), self.length - self.received)
+        self.data[self.received : self.received + n] = chunk[:n]
+        self.received += n
+
+        self.done = typ in (0x1, 0x3)  # Last packet
+        return wants_ack
+
+    def retry(self) -> bool:
+        """Called when waiting for the next chunk timed out. Returns
+        True if a retransmission should be requested"""
+        if (self.data is None and not self.missing) or self.retries >= MAX_RX_RETRIES:
+            return False
+
+        self.retries += 1
+        return True
+
+    def result(self) -> bytes:
+        assert self.data is not None and self.received == self.length
+        return bytes(self.data)
+
+
+class TP20Channel:
+    def __init__(
+        self,
+        panda: Panda,
+        module: int,
+        bus: int = 0,
+        timeout: float = 0.1,
+        debug: bool = False,
+        t1: float = 0.1,
+        t3: float = 0.001,
+        keepalive: bool = True,
+        dispatcher: Optional[BusDispatcher] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        """Channel state and message framing shared by the blocking and the
+        asyncio transport. t1 (ack timeout) and t3 (interval between packets)
+        are requested from the ECU, the values it replies with are used for the
+        channel. With keepalive enabled a channel test is sent in the background
+        whenever the channel is idle.
+
+        Multiple channels can share a panda by passing the same dispatcher,
+        otherwise the channel creates its own. Frames, timeouts, ack wait and
+        pacing time are counted when metrics is passed."""
         self.panda = panda
+        self.module = module
         self.bus = bus
         self.timeout = timeout
-        self.msgs: List[Tuple[int, bytes]] = []
+
+        self.owns_dispatcher = dispatcher is None
+        self.dispatcher = BusDispatcher(panda, bus, debug) if dispatcher is None else dispatcher
 
         self.tx_seq = 0
-        self.rx_seq = 0
+        self.rx_seq = 0  # Next expected sequence number from the ECU
         self.time_between_packets = 0.0
+        self.bulk_send = False
+        self.next_tx_time = 0.0
+
+        self.frames_lost = 0
+        self.frames_recovered = 0
+
+        self.block_size = 0
+        self.t1 = t1
+        self.t3 = t3
+
+        self.connected = False
+        self.keepalive = keepalive
+        self.keepalive_pending = False
+        self.last_activity = time.monotonic()
+
+        # Set while a message is being sent, so the keepalive never interleaves with it
+        self.busy = False
+
+        # Held while a single frame is sent
+        self.frame_lock = threading.Lock()
 
         self.debug = debug
-        self.open_channel(module)
+        self.metrics = metrics
+
+        self.tx_addr = 0
+        self.rx_addr = self.dispatcher.register(self)
+
+    def release(self):
+        """Release the channel's RX address, and stop the
+        dispatcher if it was created by this channel."""
+        self.connected = False
+        self.dispatcher.unregister(self.rx_addr)
+        if self.owns_dispatcher:
+            self.dispatcher.close()
+
+    def filter_frame(self, dat: bytes) -> bool:
+        """Called by the dispatcher for every frame on our RX address.
+        Returns False for frames that should not be queued."""
+        self.last_activity = time.monotonic()
+
+        # Absorb the reply to our channel test
+        if self.keepalive_pending and dat[:1] == b"\xa1":
+            self.keepalive_pending = False
+            return False
+
+        return True
+
+    def keep_alive(self):
+        """Send a channel test (0xA3) when nothing was sent or received
+        on the channel for close to T1. Skipped while a message is
+        being sent, the reply is dropped by filter_frame."""
+        if not self.keepalive or not self.connected or self.busy:
+            return
+
+        if time.monotonic() - self.last_activity < KEEPALIVE_MARGIN * self.t1:
+            return
+
+        if not self.frame_lock.acquire(blocking=False):
+            return
+
+        try:
+            if not self.busy:
+                self.keepalive_pending = True
+                self.transmit(b"\xa3", self.tx_addr)
+                if self.metrics is not None:
+                    self.metrics.inc("tp20_keepalives_total")
+        except Exception as e:
+            if self.debug:
+                print(f"Failed to send keepalive: {e}")
+        finally:
+            self.frame_lock.release()
+
+    def transmit(self, dat: bytes, addr: int):
+        """Send a single frame without pacing, frame_lock must be held"""
+        if self.debug:
+            print(f"TX: {hex(addr)} - {dat.hex()}")
 
-    def can_recv(self, addr: Optional[int] = None) -> bytes:
-        """Receive messages until a message with the specified address
-        is received. Messages on other addresses, or a second message
-        with the specified address, will be stored and are returned
-        on subsequent calls."""
+        self.dispatcher.send(addr, dat, self.timeout)
+        if self.metrics is not None:
+            self.metrics.inc("tp20_frames_sent_total")
 
-        if addr is None:
-            addr = self.rx_addr
+        self.last_activity = time.monotonic()
+        self.next_tx_time = self.last_activity + self.time_between_packets
 
-        start_time = time.monotonic()
-        while time.monotonic() - start_time < self.timeout:
-            while len(self.msgs):
-                a, dat = self.msgs.pop(0)
-                if a == addr:
-                    return dat
+    def transmit_many(self, dats: List[bytes], addr: int):
+        """Send frames in a single bulk transfer, frame_lock must be held"""
+        if self.debug:
+            for dat in dats:
+                print(f"TX: {hex(addr)} - {dat.hex()}")
 
-            for a, _, dat, bus in self.panda.can_recv():
-                if a != addr:
-                    continue
+        self.dispatcher.send_many(addr, dats, self.timeout)
+        if self.metrics is not None:
+            self.metrics.inc("tp20_frames_sent_total", len(dats))
 
-                if bus != self.bus:
-                    continue
+        self.last_activity = time.monotonic()
+        self.next_tx_time = self.last_activity + self.time_between_packets
 
-                if self.debug:
-                    print(f"RX: {hex(a)} - {dat.hex()}")
-                self.msgs.append((a, dat))
+    def tx_delay(self) -> float:
+        """Time left until T3 has passed since the previous frame"""
+        return self.next_tx_time - time.monotonic()
 
-        raise MessageTimeoutError("Timed out waiting for message")
+    def count_sleep(self, delay: float):
+        if self.metrics is not None:
+            self.metrics.inc("tp20_send_sleep_seconds_total", delay)
 
-    def can_send(self, dat: bytes, addr: Optional[int] = None):
-        if addr is None:
-            addr = self.tx_addr
+    def count_recv(self, dat: Optional[bytes]):
+        """Called with the received frame, or None on a timeout"""
+        if self.metrics is not None:
+            self.metrics.inc("tp20_frames_received_total" if dat is not None else "tp20_timeouts_total")
 
-        if self.debug:
-            print(f"TX: {hex(addr)} - {dat.hex()}")
-        self.panda.can_send(addr, dat, self.bus, int(self.timeout * 1000))
-        time.sleep(self.time_between_packets)
+    def count_ack_wait(self, start: float):
+        if self.metrics is not None:
+            self.metrics.observe("tp20_ack_wait_seconds", time.monotonic() - start)
 
-    def open_channel(self, module: int):
+    def setup_request(self) -> bytes:
         """Before communicating to an ECU we have to open a channel.
         This is done on the broadcast address of 0x200. We expect a
         reply on 0x200 + module logial address. We ask the destination module
-        to broadcast on 0x300. It will reply with an address for us to transmit on."""
+        to broadcast on the RX address reserved by the dispatcher (0x300 for
+        the first channel). It will reply with an address for us to transmit on."""
+        self.connected = False
+
+        # A channel test that was never answered must not swallow the parameters response
+        self.keepalive_pending = False
 
         # Dest: <module>
         # Opcode 0xc0 (setup)
         # RX ID: V = 1 (invalid), 0x1000
-        # TX ID: 0x300 + V = 0 (valid), 0x0300
+        # TX ID: 0x300 + V = 0 (valid), e.g. 0x0300
         # Application type: 0x01
-        self.can_send(bytes([module]) + b"\xc0\x00\x10\x00\x03\x01", BROADCAST_ADDR)
+        self.dispatcher.clear(BROADCAST_ADDR + self.module)
+        return bytes([self.module, 0xC0, 0x00, 0x10]) + struct.pack("<H", self.rx_addr) + b"\x01"
 
+    def handle_setup_response(self, dat: bytes):
         # Channel setup response (e.g. 00d00003a80701)
-        dat = self.can_recv(BROADCAST_ADDR + module)
         if self.debug:
             print(f"Got channel setup response {dat.hex()}")
 
@@ -93,88 +503,454 @@ class TP20Transport:
         if status != 0xD0:
             raise RuntimeError(f"Failed to setup channel, got {dat.hex()}")
 
-        assert rx == 0x300  # We asked for this
+        assert rx == self.rx_addr  # We asked for this
 
-        self.rx_addr = rx
         self.tx_addr = tx
 
+    def parameters_request(self) -> bytes:
         # Set timing parameters
         # Opcode: 0xa0 (Parameters request)
         # Block size: 0x0f
-        # T1: 0x8a (time to wait for ack, 10ms * 10 = 100ms)
+        # T1: time to wait for ack (e.g. 0x8a: 10ms * 10 = 100ms)
         # T2: 0xff (always 0xff)
-        # T3: 0x0a (interval between packets, 0.1ms * 10 = 1ms)
+        # T3: interval between packets (e.g. 0x0a: 0.1ms * 10 = 1ms)
         # T4: 0xff (always 0xff)
-        self.can_send(b"\xa0\x0f\x8a\xff\x0a\xff")
+        return bytes([0xA0, 0x0F, encode_timing(self.t1), 0xFF, encode_timing(self.t3), 0xFF])
 
+    def handle_parameters_response(self, dat: bytes):
         # Receive timing parameters (e.g. a10f8aff4aff)
         # 0x8a: 10ms * 10 = 100ms
         # 0x4a: 1ms * 10 = 10ms
-        dat = self.can_recv()
         if self.debug:
             print(f"Got timing params {dat.hex()}")
-        opcode, bs, t1, t4 = struct.unpack("<BBBxBx", dat)
+        opcode, bs, t1, t3 = struct.unpack("<BBBxBx", dat)
         assert opcode == 0xA1
 
-        # TODO: parse response
-        self.time_between_packets = 0.01
+        self.block_size = bs
+        self.t1 = decode_timing(t1)
+        self.t3 = decode_timing(t3)
+        self.time_between_packets = self.t3
+        self.bulk_send = self.t3 <= BULK_SEND_MAX_T3 and hasattr(self.panda, "can_send_many")
 
         self.tx_seq = 0
         self.rx_seq = 0
+        self.connected = True
 
-    def wait_for_ack(self):
+    def check_ack(self, dat: bytes):
         """Even though both sides have their own sequence counter
         we expect an ack with our own sequence + 1"""
+        if dat[:1] == b"\xa8":
+            self.handle_disconnect()
+
         seq = (self.tx_seq + 1) & 0xF
-        if self.can_recv() != bytes([0xB0 | seq]):
+        if dat != bytes([0xB0 | seq]):
             raise RuntimeError("Wrong ack received")
 
-    def send_ack(self):
-        """Even though both sides have their own sequence counter
-        we send an ack with the counter from the other side + 1"""
-        seq = (self.rx_seq + 1) & 0xF
-        self.can_send(bytes([0xB0 | seq]))
+    def handle_disconnect(self):
+        self.connected = False
+        raise ChannelClosedError("Channel closed by ECU")
 
-    def send(self, dat: bytes):
-        """Sends longer string of data by dividing into smaller chunks
-        and waiting for acknowledge after the last chunk"""
-        if len(dat) > 0xFF:
-            raise ValueError("Packet longer than 255 bytes not supported")
+    def ack(self) -> bytes:
+        """Even though both sides have their own sequence counter
+        we send an ack with the counter from the other side + 1,
+        which is the next sequence number we expect. If frames were
+        lost the sender will retransmit starting at that number."""
+        return bytes([0xB0 | self.rx_seq])
+
+    def frames(self, dat: bytes) -> Iterator[Tuple[bytes, bool]]:
+        """Divides a message into chunks, and yields each chunk together
+        with whether we have to wait for an ack after sending it.
+        The receiver acknowledges every block of block_size chunks
+        and the last chunk, after which the next block is sent"""
+        if len(dat) > MAX_MESSAGE_SIZE:
+            raise ValueError(f"Packet longer than {MAX_MESSAGE_SIZE} bytes not supported")
 
         # Prepend length
-        payload = struct.pack(">H", len(dat)) + dat
+        payload = memoryview(struct.pack(">H", len(dat)) + dat)
 
-        while payload:
-            last = len(payload) <= 7  # Wait for ack on last packet
+        frames_in_block = 0
+        for offset in range(0, len(payload), 7):
+            last = offset + 7 >= len(payload)
+            frames_in_block += 1
+            end_of_block = frames_in_block == self.block_size
 
-            to_send = bytes([(0x10 if last else 0x20) | self.tx_seq])
-            to_send += payload[:7]
+            # Opcode 0x0: wait for ack, more packets follow
+            # Opcode 0x1: wait for ack, last packet
+            # Opcode 0x2: not waiting for ack, more packets follow
+            if last:
+                opcode = 0x10
+            elif end_of_block:
+                opcode = 0x00
+            else:
+                opcode = 0x20
 
-            self.can_send(to_send)
+            yield bytes([opcode | self.tx_seq]) + payload[offset : offset + 7], last or end_of_block
 
-            if last:
-                self.wait_for_ack()
+            if last or end_of_block:
+                frames_in_block = 0
 
             self.tx_seq = (self.tx_seq + 1) & 0xF
 
-            payload = payload[7:]
+    def windows(self, dat: bytes) -> Iterator[Tuple[List[bytes], bytes]]:
+        """Groups the frames of a message into the frames that can be sent
+        back to back, and the frame after them that waits for an ack"""
+        window: List[bytes] = []
+        for frame, wait_for_ack in self.frames(dat):
+            if wait_for_ack:
+                yield window, frame
+                window = []
+            else:
+                window.append(frame)
+
+
+class TP20Transport(TP20Channel):
+    def __init__(
+        self,
+        panda: Panda,
+        module: int,
+        bus: int = 0,
+        timeout: float = 0.1,
+        debug: bool = False,
+        t1: float = 0.1,
+        t3: float = 0.001,
+        keepalive: bool = True,
+        dispatcher: Optional[BusDispatcher] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        """Create TP20Transport object and open a channel. See
+        TP20Channel for the arguments."""
+        super().__init__(panda, module, bus, timeout, debug, t1, t3, keepalive, dispatcher, metrics)
+
+        # Held while sending a message, so threads don't interleave messages
+        self.tx_lock = threading.RLock()
+
+        try:
+            self.open_channel(module)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.release()
+
+    def can_recv(self, addr: Optional[int] = None, timeout: Optional[float] = None) -> bytes:
+        """Wait until a message with the specified address is received,
+        by default on the RX address of this channel"""
 
-    def recv(self) -> bytes:
-        """Receives multiple chunks of a response and combines
-        them into a single string"""
-        payload = b""
-        while True:
-            dat = self.can_recv()
-            payload += dat[1:]
+        if addr is None:
+            addr = self.rx_addr
 
-            typ, seq = dat[0] >> 4, dat[0] & 0xF
-            self.rx_seq = seq  # TODO: Check
+        try:
+            dat = self.dispatcher.recv(addr, self.timeout if timeout is None else timeout)
+        except MessageTimeoutError:
+            self.count_recv(None)
+            raise
+        self.count_recv(dat)
+
+        if self.debug:
+            print(f"RX: {hex(addr)} - {dat.hex()}")
+        return dat
+
+    def can_send(self, dat: bytes, addr: Optional[int] = None):
+        if addr is None:
+            addr = self.tx_addr
+
+        with self.frame_lock:
+            # Only sleep when the previous frame was sent less than T3 ago
+            delay = self.tx_delay()
+            if delay > 0:
+                time.sleep(delay)
+                self.count_sleep(delay)
+
+            self.transmit(dat, addr)
+
+    def can_send_many(self, dats: List[bytes], addr: Optional[int] = None):
+        if addr is None:
+            addr = self.tx_addr
 
-            if typ == 0x1:  # Last packet, send ack and return data
+        with self.frame_lock:
+            delay = self.tx_delay()
+            if delay > 0:
+                time.sleep(delay)
+                self.count_sleep(delay)
+
+            self.transmit_many(dats, addr)
+
+    def open_channel(self, module: int, setup_timeout: Optional[float] = None):
+        self.module = module
+        self.can_send(self.setup_request(), BROADCAST_ADDR)
+        self.handle_setup_response(self.can_recv(BROADCAST_ADDR + module, setup_timeout))
+
+        self.can_send(self.parameters_request())
+        self.handle_parameters_response(self.can_recv())
+
+    def reconnect(self, timeout: float = RECONNECT_TIMEOUT):
+        """Open the channel again after the ECU rebooted, e.g. after a session
+        change. The first probe waits until the ECU had time to reset, then
+        channel setup is probed at growing intervals. Addresses that were
+        active and went silent are watched, as soon as the ECU is heard again
+        it's probed right away. Failed probes are retried until the timeout.
+        The RX address is kept, so clients using the transport can continue."""
+        with self.tx_lock:
+            self.connected = False
+            start = time.monotonic()
+            deadline = start + timeout
+
+            known = self.dispatcher.active_addrs() - {self.rx_addr, BROADCAST_ADDR + self.module}
+            for addr in known:
+                self.dispatcher.clear(addr)
+
+            time.sleep(max(0.0, min(RECONNECT_SILENCE_WINDOW, deadline - time.monotonic())))
+            silent = known - self.dispatcher.active_addrs()
+
+            # While the ECU is silent, it's only probed once it's heard again or the interval passed
+            probe = not silent
+            interval = RECONNECT_MIN_INTERVAL
+            while True:
+                if probe:
+                    self.dispatcher.clear(self.rx_addr)
+                    self.dispatcher.clear(BROADCAST_ADDR + self.module)
+                    try:
+                        self.open_channel(self.module, RECONNECT_PROBE_TIMEOUT)
+                        return
+                    except (MessageTimeoutError, ChannelClosedError, RuntimeError, AssertionError, struct.error):
+                        # While the bootloader comes up it can reject the setup or send unexpected frames
+                        if time.monotonic() + RECONNECT_MIN_INTERVAL >= deadline:
+                            raise
+                probe = True
+
+                wait = max(0.0, min(interval, deadline - time.monotonic()))
+                if silent:
+                    heard = self.dispatcher.wait_any(silent, wait)
+                else:
+                    time.sleep(wait)
+                    heard = False
+
+                if heard:
+                    # The ECU is back, probe again after each of its frames
+                    for addr in silent:
+                        self.dispatcher.clear(addr)
+                    interval = RECONNECT_MIN_INTERVAL
+                else:
+                    interval = min(interval * RECONNECT_BACKOFF, RECONNECT_MAX_INTERVAL)
+
+    def wait_for_ack(self):
+        start = time.monotonic()
+        self.check_ack(self.can_recv())
+        self.count_ack_wait(start)
+
+    def send_ack(self):
+        self.can_send(self.ack())
+
+    def send(self, dat: bytes):
+        """Sends longer string of data by dividing into smaller chunks
+        and waiting for an acknowledge after every block"""
+        with self.tx_lock:
+            self.busy = True
+            try:
+                if self.bulk_send:
+                    for window, frame in self.windows(dat):
+                        if window:
+                            self.can_send_many(window)
+                        self.can_send(frame)
+                        self.wait_for_ack()
+                else:
+                    for frame, wait_for_ack in self.frames(dat):
+                        self.can_send(frame)
+                        if wait_for_ack:
+                            self.wait_for_ack()
+            finally:
+                self.busy = False
+
+    def recv(self, timeout: Optional[float] = None) -> bytes:
+        """Receives multiple chunks of a response and combines
+        them into a single string. timeout overrides how long
+        to wait for the first chunk."""
+        buf = MessageBuffer(self)
+        while not buf.done:
+            try:
+                dat = self.can_recv(timeout=timeout if buf.data is None else None)
+            except MessageTimeoutError:
+                if not buf.retry():
+                    raise
+                self.send_ack()
+                continue
+
+            if buf.feed(dat):
                 self.send_ack()
+
+        return buf.result()
+
+
+class AsyncTP20Transport(TP20Channel):
+    def __init__(
+        self,
+        panda: Panda,
+        module: int,
+        bus: int = 0,
+        timeout: float = 0.1,
+        debug: bool = False,
+        t1: float = 0.1,
+        t3: float = 0.001,
+        keepalive: bool = True,
+        dispatcher: Optional[BusDispatcher] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        """asyncio version of TP20Transport. Use the create() coroutine to
+        construct it and open the channel. Frames are still read by the
+        dispatcher thread, which wakes up the event loop."""
+        super().__init__(panda, module, bus, timeout, debug, t1, t3, keepalive, dispatcher, metrics)
+
+        self.loop = asyncio.get_running_loop()
+        self.rx_event = asyncio.Event()
+
+        # Held while sending a message, so tasks don't interleave messages
+        self.tx_lock = asyncio.Lock()
+
+        self.dispatcher.add_listener(self.rx_addr, self.wakeup)
+        self.dispatcher.add_listener(BROADCAST_ADDR + module, self.wakeup)
+
+    @classmethod
+    async def create(cls, panda: Panda, module: int, **kwargs) -> "AsyncTP20Transport":
+        """Create AsyncTP20Transport object and open a channel"""
+        self = cls(panda, module, **kwargs)
+        try:
+            await self.open_channel(module)
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.dispatcher.remove_listener(self.rx_addr, self.wakeup)
+        self.dispatcher.remove_listener(BROADCAST_ADDR + self.module, self.wakeup)
+        self.release()
+
+    def wakeup(self):
+        """Called from the dispatcher thread when a frame was queued"""
+        try:
+            self.loop.call_soon_threadsafe(self.rx_event.set)
+        except RuntimeError:  # Event loop closed
+            pass
+
+    async def can_recv(self, addr: Optional[int] = None, timeout: Optional[float] = None) -> bytes:
+        """Wait until a message with the specified address is received,
+        by default on the RX address of this channel"""
+
+        if addr is None:
+            addr = self.rx_addr
+
+        deadline = self.loop.time() + (self.timeout if timeout is None else timeout)
+        while True:
+            dat = self.dispatcher.try_recv(addr)
+            if dat is not None:
                 break
 
-        length = struct.unpack(">H", payload[:2])[0]
-        data = payload[2 : length + 2]
-        assert len(data) == length
-        return data
+            self.rx_event.clear()
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                self.count_recv(None)
+                raise MessageTimeoutError("Timed out waiting for message")
+
+            try:
+                await asyncio.wait_for(self.rx_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        self.count_recv(dat)
+
+        if self.debug:
+            print(f"RX: {hex(addr)} - {dat.hex()}")
+        return dat
+
+    async def can_send(self, dat: bytes, addr: Optional[int] = None):
+        if addr is None:
+            addr = self.tx_addr
+
+        # Only sleep when the previous frame was sent less than T3 ago
+        delay = self.tx_delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            self.count_sleep(delay)
+
+        with self.frame_lock:
+            self.transmit(dat, addr)
+
+    async def can_send_many(self, dats: List[bytes], addr: Optional[int] = None):
+        if addr is None:
+            addr = self.tx_addr
+
+        delay = self.tx_delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            self.count_sleep(delay)
+
+        with self.frame_lock:
+            self.transmit_many(dats, addr)
+
+    async def open_channel(self, module: int):
+        self.module = module
+        await self.can_send(self.setup_request(), BROADCAST_ADDR)
+        self.handle_setup_response(await self.can_recv(BROADCAST_ADDR + module))
+
+        await self.can_send(self.parameters_request())
+        self.handle_parameters_response(await self.can_recv())
+
+    async def wait_for_ack(self):
+        start = time.monotonic()
+        self.check_ack(await self.can_recv())
+        self.count_ack_wait(start)
+
+    async def send_ack(self):
+        await self.can_send(self.ack())
+
+    async def send(self, dat: bytes):
+        """Sends longer string of data by dividing into smaller chunks
+        and waiting for an acknowledge after every block"""
+        async with self.tx_lock:
+            self.busy = True
+            try:
+                if self.bulk_send:
+                    for window, frame in self.windows(dat):
+                        if window:
+                            await self.can_send_many(window)
+                        await self.can_send(frame)
+                        await self.wait_for_ack()
+                else:
+                    for frame, wait_for_ack in self.frames(dat):
+                        await self.can_send(frame)
+                        if wait_for_ack:
+                            await self.wait_for_ack()
+            finally:
+                self.busy = False
+
+    async def recv(self, timeout: Optional[float] = None) -> bytes:
+        """Receives multiple chunks of a response and combines
+        them into a single string. timeout overrides how long
+        to wait for the first chunk."""
+        buf = MessageBuffer(self)
+        while not buf.done:
+            try:
+                dat = await self.can_recv(timeout=timeout if buf.data is None else None)
+            except MessageTimeoutError:
+                if not buf.retry():
+                    raise
+                await self.send_ack()
+                continue
+
+            if buf.feed(dat):
+                await self.send_ack()
+
+        return buf.result()